@@ -41,14 +41,15 @@ __version__=  '1.5.2'
 # OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 #
 
-import sys, difflib, argparse, unicodedata, re, codecs
+import sys, difflib, argparse, unicodedata, re, codecs, bisect, heapq
 # import pprint, pdb
 
 if sys.hexversion < 0x02070000:
     raise SystemExit('*** Requires python >= 2.7.0')    # pragma: no cover
 
 import filecmp
-import os, stat
+import os, stat, errno
+import tempfile, pickle, mmap, hashlib, copy
 try: import io # python2.x
 except(ImportError): pass # python3.x
 
@@ -59,42 +60,90 @@ except(AttributeError):
     itertools.zip_longest = itertools.izip_longest
 
 import functools
+import collections
+import operator
+import time
+from array import array
 
 BUFSIZE = 8*1024
 
+_clock = getattr(time, 'monotonic', time.time)
+
 _colormodes = {'always': True, 'never': False, 'auto': None}
 
-def _getcolor(withcolor, tag, side, openclose, isdircmp=False, withbg=False):
-    if not withcolor: return ''
-    bg1 = '' if not withbg else ';47'
-    bg2 = '' if not withbg else ';47'
-    bold = ';1'
-
-    ansi_colors = {
-        'red': '31',
-        'grn': '32',
-        'ylw': '33',
-        'ble': '34',
+# 差分の色付けに使うANSIエスケープシーケンスをあらかじめ組み立てておくクラス
+class Theme:
+    r"""Precomputed ANSI escape sequences to color the differences.
+
+    palette is one of the names in Theme.palettes, or a dict that maps
+    color names ('red', 'grn', 'ylw', 'ble' and 'bg') to SGR parameters
+    (missing names are taken from the 'ansi' palette).
+
+    Example:
+
+    >>> theme = Theme()
+    >>> theme.pair('<', 0)
+    ('\x1b[31;1m', '\x1b[0m')
+    >>> theme.pair('-', 0, withbg=True)
+    ('\x1b[31;47;1m', '\x1b[0m')
+    >>> theme.pair('|', 0), theme.pair('|', 0, isdircmp=True)
+    (('', ''), ('\x1b[34;1m', '\x1b[0m'))
+    >>> Theme('256').pair('+', 1)
+    ('\x1b[38;5;28;1m', '\x1b[0m')
+    >>> Theme({'grn': '38;2;0;255;0'}).pair('>', 1)
+    ('\x1b[38;2;0;255;0;1m', '\x1b[0m')
+    """
+
+    palettes = {
+        'ansi': {'red': '31', 'grn': '32', 'ylw': '33', 'ble': '34', 'bg': '47'},
+        '256': {'red': '38;5;160', 'grn': '38;5;28', 'ylw': '38;5;136',
+                'ble': '38;5;25', 'bg': '48;5;255'},
+        'truecolor': {'red': '38;2;203;36;49', 'grn': '38;2;26;127;55',
+                      'ylw': '38;2;154;103;0', 'ble': '38;2;9;105;218',
+                      'bg': '48;2;246;248;250'},
         }
-    colors = {
-        '<': (('\033[' + ansi_colors['red'] + bg2 + bold + 'm', '\033[0m'),
-              ('', '')),
-        '>': (('', ''),
-              ('\033[' + ansi_colors['grn'] + bg2 + bold + 'm', '\033[0m')),
-        '|': ((('\033[' + ansi_colors['ble'] + bg2 + bold + 'm', '\033[0m'),
-               ('\033[' + ansi_colors['ble']  + bg2 + bold + 'm', '\033[0m'))
-               if isdircmp else (('', ''), ('', ''))),
-        '-': (('\033[' + ansi_colors['red'] + bg1 + bold + 'm', '\033[0m'),
-              ('', '')),
-        '+': (('', ''),
-              ('\033[' + ansi_colors['grn'] + bg1 + bold + 'm', '\033[0m')),
-        '!': (('\033[' + ansi_colors['red'] + bg1 + bold + 'm', '\033[0m'),
-              ('\033[' + ansi_colors['grn'] + bg1 + bold + 'm', '\033[0m')),
-        '?': (('\033[' + ansi_colors['ylw'] + bg1 + bold + 'm', '\033[0m'),
-              ('\033[' + ansi_colors['ylw'] + bg1 + bold + 'm', '\033[0m')),
-        ' ': (('', ''), ('', '')),
+
+    # タグごとの(左側, 右側)の色
+    tagcolors = {
+        '<': ('red', None),
+        '>': (None, 'grn'),
+        '|': (None, None),
+        '-': ('red', None),
+        '+': (None, 'grn'),
+        '!': ('red', 'grn'),
+        '?': ('ylw', 'ylw'),
+        ' ': (None, None),
         }
-    return colors[tag][side][openclose]
+    dircmp_tagcolors = dict(tagcolors, **{'|': ('ble', 'ble')})
+
+    def __init__(self, palette='ansi', bold=True):
+        if not isinstance(palette, dict):
+            if palette not in self.palettes:
+                raise ValueError('unknown palette \'' + str(palette) + '\'')
+            palette = self.palettes[palette]
+        colors = dict(self.palettes['ansi'])
+        colors.update(palette)
+
+        # (タグ, 左右, 背景色の有無, ディレクトリ比較か)の組み合わせごとに
+        # 開始と終了のシーケンスを組み立てておく
+        self.codes = {}
+        for withbg in (False, True):
+            for isdircmp in (False, True):
+                tagcolors = self.dircmp_tagcolors if isdircmp else self.tagcolors
+                for tag, names in tagcolors.items():
+                    for side, name in enumerate(names):
+                        if name is None:
+                            codes = ('', '')
+                        else:
+                            codes = ('\033[' + colors[name] +
+                                     (';' + colors['bg'] if withbg else '') +
+                                     (';1' if bold else '') + 'm', '\033[0m')
+                        self.codes[(tag, side, withbg, isdircmp)] = codes
+
+    def pair(self, tag, side, withbg=False, isdircmp=False):
+        return self.codes[(tag, side, withbg, isdircmp)]
+
+_default_theme = Theme()
 
 def _is_text(filepath):
     bufsize = BUFSIZE
@@ -113,6 +162,233 @@ def _is_text(filepath):
         fp.close()
     return True
 
+# ファイル内の位置を入れる、64bitの整数の列を返す
+# （Python 2.7のarrayには'q'が無いので'L'を使い、'L'が64bitに満たなければlistにする）
+def _offset_array():
+    for typecode in ('L', 'q'):
+        try: offsets = array(typecode, [0])
+        except ValueError: continue
+        if offsets.itemsize >= 8: return offsets
+    return [0]
+
+# ファイルをmmapで開き、行の位置だけを索引して、必要な行だけをデコードするシーケンス
+# （Differ.compareにそのまま渡せる。MappedLines同士は生のバイト列で一致を判定する）
+class MappedLines:
+    r"""Memory-mapped lines of a file, decoded lazily (sequence of strings).
+
+    Only the offsets of lines are indexed when opened. A line is decoded by
+    encoding (and transformed by transform, if given) when it is accessed.
+    Lines are split at '\n' (the line end is kept unless strip_eol is True,
+    which strips '\r' and '\n' like --ignore-crlf). The encoding must encode
+    '\n' as b'\n' (e.g. utf-8, latin-1, euc-jp; not utf-16).
+
+    A UnicodeDecodeError is raised when a line that cannot be decoded is
+    accessed; it carries file_index, if given (like the lines of --window).
+    With validate, the whole file is decoded once in chunks when opened
+    (without keeping the result), so that the error is raised there instead.
+    Close it with close() or use it as a context manager.
+
+    Example:
+
+    >>> import tempfile, os
+    >>> fd, path = tempfile.mkstemp()
+    >>> _ = os.write(fd, u'a\r\n\u3042\nlast'.encode('utf-8')); os.close(fd)
+    >>> lines = MappedLines(path, 'utf-8')
+    >>> len(lines), lines[0] == u'a\r\n', lines[-1] == u'last'
+    (3, True, True)
+    >>> lines[1] == u'\u3042\n'
+    True
+    >>> with MappedLines(path, 'utf-8', strip_eol=True) as stripped:
+    ...     list(stripped.raw_keys()) == [b'a', b'\xe3\x81\x82', b'last']
+    True
+    >>> lines.close()
+    >>> with MappedLines(path, 'ascii', file_index=1) as wrong:
+    ...     try: wrong[1]
+    ...     except UnicodeDecodeError as error: print(error.file_index)
+    1
+    >>> MappedLines(path, 'ascii', validate=True)
+    Traceback (most recent call last):
+        ...
+    UnicodeDecodeError: 'ascii' codec can't decode byte 0xe3 in position 3: ordinal not in range(128)
+    >>> os.remove(path)
+    """
+
+    def __init__(self, path, encoding='utf-8', strip_eol=False, transform=None,
+                 validate=False, file_index=None):
+        if u'\n'.encode(encoding) != b'\n':
+            raise ValueError('encoding \'' + encoding + '\' is not supported by MappedLines')
+        self.path = path
+        self.encoding = codecs.lookup(encoding).name
+        self.strip_eol = strip_eol
+        self.transform = transform
+        self.file_index = file_index
+        self._file = open(path, 'rb')
+        try:
+            self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError: # 空のファイルはmmapできない
+            self._data = b''
+        if validate:
+            try:
+                self._validate()
+            except UnicodeDecodeError:
+                self.close()
+                raise
+
+        # 各行の先頭の位置（と最後の行の終わりの位置）を索引する
+        data = self._data
+        starts = _offset_array()
+        find = data.find
+        pos = find(b'\n')
+        while pos != -1:
+            starts.append(pos + 1)
+            pos = find(b'\n', pos + 1)
+        if starts[-1] != len(data): starts.append(len(data))
+        self._starts = starts
+        self._decoded = {}
+
+    # ファイル全体を塊ごとにデコードして、デコードできることを確かめる（結果は捨てる）
+    def _validate(self, chunk=1 << 20):
+        decoder = codecs.getincrementaldecoder(self.encoding)()
+        data = self._data
+        for offset in range(0, len(data), chunk):
+            decoder.decode(data[offset:offset + chunk])
+        decoder.decode(b'', True)
+
+    def map(self, transform):
+        """Give back the lines of the same file with transform applied after decoding."""
+        mapped = copy.copy(self)
+        if self.transform is not None:
+            transform = (lambda line, first=self.transform, second=transform:
+                         second(first(line)))
+        mapped.transform = transform
+        mapped._decoded = {}
+        return mapped
+
+    def __len__(self):
+        return len(self._starts) - 1
+
+    def raw(self, index):
+        line = self._data[self._starts[index]:self._starts[index + 1]]
+        if self.strip_eol: line = line.rstrip(b'\r\n')
+        return line
+
+    def raw_keys(self):
+        """Give back an iterator of the raw bytes of lines (keys for matching)."""
+        for index in range(len(self)):
+            yield self.raw(index)
+
+    def decode_key(self, key):
+        try:
+            line = key.decode(self.encoding)
+        except UnicodeDecodeError as error:
+            # どちらのファイルかが分かっていれば付けておく（_decode_lazilyと同じ）
+            if self.file_index is not None: error.file_index = self.file_index
+            raise
+        if self.transform is not None: line = self.transform(line)
+        return line
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0: index += len(self)
+        if not 0 <= index < len(self): raise IndexError('line index out of range')
+        try:
+            return self._decoded[index]
+        except KeyError:
+            pass
+        # 行内差分などで同じ行を何度も参照するので、デコードした行を少しだけ覚えておく
+        if len(self._decoded) >= 4096: self._decoded.clear()
+        line = self._decoded[index] = self.decode_key(self.raw(index))
+        return line
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def close(self):
+        if not isinstance(self._data, bytes): self._data.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+# MappedLinesで開けるエンコーディングか（'\n'がb'\n'になるか）を返す
+def _is_mappable(*encodings):
+    return all(u'\n'.encode(encoding) == b'\n' for encoding in encodings)
+
+# 生のバイト列で比較してよいか（同じエンコーディングのMappedLines同士か）を返す
+def _is_raw_comparable(seq1, seq2):
+    return (isinstance(seq1, MappedLines) and isinstance(seq2, MappedLines) and
+            seq1.encoding == seq2.encoding and seq1.strip_eol == seq2.strip_eol)
+
+# 文字の幅の分類(0: 幅1, 1: 幅2, 2: 曖昧)
+#
+# F [幅2] (Fullwidth; 全角) - 互換分解特性 <wide> を持つ互換文字。
+#    文字の名前に "FULLWIDTH" を含む。いわゆる全角英数など。
+# H [幅1] (Halfwidth; 半角) - 互換分解特性 <narrow> を持つ互換文字。
+#    文字の名前に "HALFWIDTH" を含む。いわゆる半角カナなど。
+# W [幅2] (Wide; 広) - 上記以外の文字で、従来文字コードではいわゆる全角であったもの。
+#    漢字や仮名文字、東アジアの組版にしか使われない記述記号 (たとえば句読点) など。
+# Na [幅1] (Narrow; 狭) - 上記以外の文字で、従来文字コードでは対応する
+#    いわゆる全角の文字が存在したもの。いわゆる半角英数など。
+# A [幅1or幅2] (Ambiguous; 曖昧) - 文脈によって文字幅が異なる文字。
+#    東アジアの組版とそれ以外の組版の両方に出現し、東アジアの従来文字コードでは
+#    いわゆる全角として扱われることがある。ギリシア文字やキリル文字など。
+# N [幅1] (Neutral; 中立) - 上記のいずれにも属さない文字。
+#    東アジアの組版には通常出現せず、全角でも半角でもない。アラビア文字など。
+_east_asian_width_classes = {'F': 1, 'W': 1, 'A': 2}
+
+# 曖昧(Ambiguous)を幅1とする場合と幅2とする場合の、分類ごとの文字幅
+_class_widths = ((1, 2, 1), (1, 2, 2))
+
+try: _unichr = unichr # python2.x
+except(NameError): _unichr = chr # python3.x
+
+# BMP(U+0000..U+FFFF)の文字の分類の表（最初に必要になった時に作成する）
+_bmp_classes = None
+# BMP以外の文字の分類のキャッシュ
+_astral_classes = {}
+
+def _load_bmp_classes():
+    global _bmp_classes
+    if _bmp_classes is None:
+        classes = bytearray(0x10000)
+        # 確実にシングルバイト文字だと分かる場合(U+0000..U+00FF)は幅1のまま
+        for code in range(0x100, 0x10000):
+            classes[code] = _east_asian_width_classes.get(
+                unicodedata.east_asian_width(_unichr(code)), 0)
+        _bmp_classes = classes
+    return _bmp_classes
+
+def _astral_class(char):
+    cls = _astral_classes.get(char)
+    if cls is None:
+        cls = _astral_classes[char] = _east_asian_width_classes.get(
+            unicodedata.east_asian_width(char), 0)
+    return cls
+
+def _isascii(text):
+    try: return text.isascii() # python3.7+
+    except(AttributeError): return False
+
+# 1文字の幅を返す関数
+def _charwidth(char, ambiguous_wide=True):
+    """A function to give back the width of a character.
+
+    Example:
+
+    >>> _charwidth('a'), _charwidth(u'\u3042'), _charwidth(u'\u03b1', ambiguous_wide=False)
+    (1, 2, 1)
+    """
+    code = ord(char)
+    if code < 0x100: return 1
+    if code < 0x10000: cls = (_bmp_classes or _load_bmp_classes())[code]
+    else: cls = _astral_class(char)
+    return _class_widths[ambiguous_wide][cls]
+
 # 文字列の幅(文字幅)を返す関数。
 # 等幅フォントで表示されるASCII文字の横幅を1とする
 # (この関数は幅広文字を表示する環境のためにある)
@@ -126,47 +402,22 @@ def _strwidth(text, ambiguous_wide=True):
 
     >>> _strwidth('teststring')
     10
+    >>> _strwidth(u'\u30c6\u30b9\u30c8string')
+    12
     """
 
-    # 文字幅の合計をリセット
+    # ASCII文字だけの場合は文字数が幅となる
+    if _isascii(text): return len(text)
+
+    # 文字の分類の表を使って、文字幅の合計を求める
+    # 詳細はWikipediaの「東アジアの文字幅」などを参照
+    classes = _bmp_classes or _load_bmp_classes()
+    widths = _class_widths[ambiguous_wide]
     width = 0
-    # 文字列を文字ごとに走査
     for char in text:
-        # 幅広文字の判定
-        if ord(char) < 256:
-            # 確実にシングルバイト文字だと分かる場合は幅は1
-            width += 1
-        else:
-            # Unicodeのデータベースに用意されている幅情報を使用する。
-            # ただし曖昧(Ambiguous)の場合だけは文脈により文字幅が変わるので、
-            # 幅1か幅2のどちらかを引数で指定できるようにする
-            # 詳細はWikipediaの「東アジアの文字幅」などを参照
-            #
-            # F [幅2] (Fullwidth; 全角) - 互換分解特性 <wide> を持つ互換文字。
-            #    文字の名前に "FULLWIDTH" を含む。いわゆる全角英数など。
-            # H [幅1] (Halfwidth; 半角) - 互換分解特性 <narrow> を持つ互換文字。
-            #    文字の名前に "HALFWIDTH" を含む。いわゆる半角カナなど。
-            # W [幅2] (Wide; 広) - 上記以外の文字で、従来文字コードではいわゆる全角であったもの。
-            #    漢字や仮名文字、東アジアの組版にしか使われない記述記号 (たとえば句読点) など。
-            # Na [幅1] (Narrow; 狭) - 上記以外の文字で、従来文字コードでは対応する
-            #    いわゆる全角の文字が存在したもの。いわゆる半角英数など。
-            # A [幅1or幅2] (Ambiguous; 曖昧) - 文脈によって文字幅が異なる文字。
-            #    東アジアの組版とそれ以外の組版の両方に出現し、東アジアの従来文字コードでは
-            #    いわゆる全角として扱われることがある。ギリシア文字やキリル文字など。
-            # N [幅1] (Neutral; 中立) - 上記のいずれにも属さない文字。
-            #    東アジアの組版には通常出現せず、全角でも半角でもない。アラビア文字など。
-
-            east_asian_width = unicodedata.east_asian_width(char)
-            # 確実に幅広文字なので幅は2
-            if east_asian_width in ['F', 'W']: width += 2
-            # 文字の横幅が良く分からない場合は引数に任せる
-            elif east_asian_width in ['A']:
-                # 曖昧(Ambiguous)が幅2の場合
-                if ambiguous_wide: width += 2
-                # 曖昧(Ambiguous)が幅1の場合
-                else: width += 1
-            # Unicodeではあるが、幅は1
-            else: width += 1
+        code = ord(char)
+        if code < 0x10000: width += widths[classes[code]]
+        else: width += widths[_astral_class(char)]
     # 文字列全体の文字幅を返す
     return width
 
@@ -191,14 +442,79 @@ def _expandtabs(text, tabsize=8, expandto='\t'):
     >>> _expandtabs('\ta\tab\tabc\tabcd\tend', tabsize=4, expandto='@')
     '@@@@a@@@ab@@abc@abcd@@@@end'
 
+    >>> _expandtabs(u'\u3042\tb', tabsize=4, expandto='@') == u'\u3042@@b'
+    True
     """
-    index = text.find('\t')
-    while index != -1:
-        real_tabsize = tabsize - _strwidth(text[:index]) % tabsize
-        text = text[:index] + (expandto * real_tabsize) + text[index + 1:]
-        index = text.find('\t', index + real_tabsize)
+    if '\t' not in text: return text
 
-    return text
+    # タブで区切った断片ごとに桁位置を進めながら、一度だけ連結する
+    expand_width = _strwidth(expandto)
+    pieces = text.split('\t')
+    column = 0
+    for i in range(len(pieces) - 1):
+        column += _strwidth(pieces[i])
+        real_tabsize = tabsize - column % tabsize
+        pieces[i] += expandto * real_tabsize
+        column += real_tabsize * expand_width
+
+    return ''.join(pieces)
+
+# 複数行のタブ文字をまとめて展開する
+def _expandtabs_lines(lines, tabsize=8, expandto='\t'):
+    r"""Expand tabs of each line (see _expandtabs)
+
+    Example:
+
+    >>> _expandtabs_lines(['a\tb', 'text'], tabsize=4, expandto='@')
+    ['a@@@b', 'text']
+    """
+    return [_expandtabs(line, tabsize, expandto) if '\t' in line else line
+            for line in lines]
+
+# 文字ごとの幅のリストを返す関数
+def _charwidths(text, ambiguous_wide=True):
+    """A function to give back the list of the width of each character.
+
+    Example:
+
+    >>> _charwidths(u'a\u3042b')
+    [1, 2, 1]
+    """
+    if _isascii(text): return [1] * len(text)
+    classes = _bmp_classes or _load_bmp_classes()
+    widths = _class_widths[ambiguous_wide]
+    return [widths[classes[ord(char)]] if ord(char) < 0x10000
+            else widths[_astral_class(char)] for char in text]
+
+# 幅の並びを指定された幅で折り返す位置を返す
+# (_strwidthdiv, _strwidthdivsyncが共有する折り返しエンジン)
+def _wrapbreaks(widths, width):
+    """Give back the indices where items of the given widths are folded.
+
+    An item wider than the width on its own still gets a row of its own
+    (the row before it is then empty), same as _strwidthdiv.
+
+    Example:
+
+    >>> _wrapbreaks([1, 1, 2, 1, 1], 2)
+    [2, 3]
+    >>> _wrapbreaks([2, 1], 1)
+    [0, 1]
+    """
+    breaks = []
+    total = 0
+    for index, item_width in enumerate(widths):
+        total += item_width
+        if total > width:
+            breaks.append(index)
+            total = item_width
+    return breaks
+
+# 折り返し位置で文字列を分割する
+def _splitat(text, breaks):
+    starts = [0] + breaks
+    ends = breaks + [len(text)]
+    return [text[start:end] for start, end in zip(starts, ends)]
 
 # 文字列を指定された幅で分割する
 def _strwidthdiv(text, width=180):
@@ -217,29 +533,16 @@ def _strwidthdiv(text, width=180):
 
     >>> _strwidthdiv('teststring', 15)
     ['teststring']
+
+    >>> _strwidthdiv(u'a\u3042\u3044b', 3) == [u'a\u3042', u'\u3044b']
+    True
     """
 
-    # 初期化
-    array = []
-    strbuffer = ''
-    strbuffer_width = 0
-    # 文字列を文字ごとに走査
-    for char in text:
-        # 文字幅を文字列長に加算する
-        strbuffer_width += _strwidth(char)
-        # もし折り返し文字幅を超えている場合は文字列を折り返す
-        if strbuffer_width > width:
-            # バッファの文字列を配列に加える
-            array.append(strbuffer)
-            strbuffer = char
-            strbuffer_width = _strwidth(char)
-        else:
-            # 文字を連結する
-            strbuffer += char
-    # バッファの文字列を配列に加える
-    array.append(strbuffer)
+    # ASCII文字だけの場合は幅ごとに切り出すだけでよい
+    if width >= 1 and _isascii(text):
+        return [text[i:i + width] for i in range(0, len(text) or 1, width)]
 
-    return array
+    return _splitat(text, _wrapbreaks(_charwidths(text), width))
 
 
 # 複数の文字列を指定された幅で同期を取って分割する
@@ -255,54 +558,989 @@ def _strwidthdivsync(textarray, width=180):
     [['tes', 't'], ['str', 'ing'], ['', '']]
     """
 
-    # 初期化
-    array = []
-    strbuffer = []
-    pos = []
-    char = []
-    strbuffer_width = 0
-
-    # 文字列の数だけ初期化する
-    for i, text in enumerate(textarray):
-        array.append([])
-        strbuffer.append('')
-        pos.append(0)
-        char.append('')
+    widths = [_charwidths(text) for text in textarray]
+    lengths = [len(text) for text in textarray]
+    pos = [0] * len(textarray)
+    # 各ステップで切り出した後の位置と、そのステップの幅
+    step_pos = []
+    step_widths = []
 
     while True:
         # 複数の文字列の中から1文字を抜き出し、
         # その中から最大の横幅(1 or 2)を計算する
-        # 範囲外の例外を抑止して空文字を返すために前後両方を指定してスライスする
-        maxwidth = max([_strwidth(text[pos[i]:pos[i]+1])
-                        for i, text in enumerate(textarray)])
-
-        # 最大の横幅(1 or 2)分だけ切り出す
-        for i, text in enumerate(textarray):
-            # 範囲外の例外を抑止して空文字を返すために前後両方を指定してスライスする
-            char[i] = _strwidthdiv(text[pos[i]:], maxwidth)[0]
-            # 先頭のポインタをずらす
-            pos[i] += len(char[i])
-        if ''.join(char) == '': break
-
-        # 文字幅を文字列長に加算する
-        strbuffer_width += maxwidth
-        # もし折り返し文字幅を超えている場合は文字列を折り返す
-        if strbuffer_width > width:
-            # バッファの文字列を配列に加える
-            for i, text in enumerate(textarray):
-                array[i].append(strbuffer[i])
-                strbuffer[i] = char[i]
-            strbuffer_width = maxwidth
+        maxwidth = max([char_widths[p] if p < length else 0
+                        for char_widths, p, length
+                        in zip(widths, pos, lengths)])
+        if maxwidth == 0: break
+
+        # 最大の横幅(1 or 2)分だけ切り出す(先頭のポインタをずらす)
+        for i, char_widths in enumerate(widths):
+            p = pos[i]
+            taken = 0
+            while p < lengths[i] and taken + char_widths[p] <= maxwidth:
+                taken += char_widths[p]
+                p += 1
+            pos[i] = p
+        step_pos.append(tuple(pos))
+        step_widths.append(maxwidth)
+
+    # ステップの単位で折り返し、各文字列での位置に読み替える
+    breaks = _wrapbreaks(step_widths, width)
+    return [_splitat(text, [step_pos[b - 1][i] if b else 0 for b in breaks])
+            for i, text in enumerate(textarray)]
+
+
+# 指定された幅に収まる先頭(または末尾)の部分文字列を返す
+def _strwidthcut(text, width, tail=False):
+    """Give back the longest head (or tail) of string within appointed width
+
+    Example:
+
+    >>> _strwidthcut('teststring', 4)
+    'test'
+    >>> _strwidthcut('teststring', 4, tail=True)
+    'ring'
+    >>> _strwidthcut(u'\u3042\u3044\u3046', 3) == u'\u3042'
+    True
+    """
+    if width <= 0: return text[:0]
+    if _isascii(text):
+        return text[-width:] if tail else text[:width]
+
+    total = 0
+    count = 0
+    for char in (reversed(text) if tail else text):
+        total += _charwidth(char)
+        if total > width: break
+        count += 1
+    return text[len(text) - count:] if tail else text[:count]
+
+# 省略の印を前後に2つ置いても指定された幅に収まるように短くする
+def _clamp_marker(marker, width):
+    if width < 2 * _strwidth(marker) + 1:
+        marker = _strwidthcut(marker, max(width - 1, 0) // 2)
+    return marker
+
+# 長い行を指定された幅に切り詰める（省略した箇所には印を付ける）
+def _truncate_text(text, width, marker='...'):
+    """Truncate string to appointed width, marking the elided tail
+
+    Example:
+
+    >>> _truncate_text('teststring', 8)
+    'tests...'
+    >>> _truncate_text('test', 8)
+    'test'
+
+    The marker is shortened when the width has no room for it:
+
+    >>> _truncate_text('teststring', 4)
+    'tes.'
+    """
+    head = _strwidthcut(text, width)
+    if len(head) == len(text): return text
+    marker = _clamp_marker(marker, width)
+    return _strwidthcut(text, width - _strwidth(marker)) + marker
+
+# 行内差分を最初の変更箇所の周辺だけに切り詰める（省略した箇所には印を付ける）
+def _truncate_linediff(linediff, width, marker='...'):
+    """Clip inline diff to a window of appointed width around its first change
+
+    The window starts a little before the first changed part, and the elided
+    parts are replaced with the marker (as unchanged parts).
+
+    Example:
+
+    >>> _truncate_linediff(
+    ...     [(' ', 'a' * 30, 'a' * 30), ('!', 'bb', 'cc'), (' ', 'd' * 30, 'd' * 30)], 20)
+    [(' ', '...', '...'), (' ', 'aaaaa', 'aaaaa'), ('!', 'bb', 'cc'), (' ', 'ddddddd', 'ddddddd'), (' ', '...', '...')]
+    >>> _truncate_linediff([(' ', 'ab', 'ab'), ('+', None, 'c')], 20)
+    [(' ', 'ab', 'ab'), ('+', None, 'c')]
+    >>> _truncate_linediff(
+    ...     [(' ', 'a' * 30, 'a' * 30), ('!', 'bb', 'cc'), (' ', 'd' * 30, 'd' * 30)], 5)
+    [(' ', '..', '..'), (' ', 'a', 'a'), (' ', '..', '..')]
+    """
+    marker = _clamp_marker(marker, width)
+    marker_width = _strwidth(marker)
+    # 末尾の省略の印の分は最初から確保しておく
+    room = width - marker_width
+    clipped = []
+
+    # 最初の変更箇所の手前は一部だけ残す
+    first = 0
+    while first < len(linediff) and linediff[first][0] == ' ': first += 1
+    if 0 < first < len(linediff):
+        (tag, text1, text2) = linediff[first - 1]
+        head1 = _strwidthcut(text1, width // 4, tail=True)
+        head2 = _strwidthcut(text2, width // 4, tail=True)
+        if first == 1 and len(head1) == len(text1) and len(head2) == len(text2):
+            first = 0
         else:
-            # 文字を連結する
-            for i, text in enumerate(textarray):
-                strbuffer[i] += char[i]
-    # バッファの文字列を配列に加える
-    for i, text in enumerate(textarray):
-        array[i].append(strbuffer[i])
+            clipped.append((' ', marker, marker))
+            clipped.append((' ', head1, head2))
+            room -= marker_width + max(_strwidth(head1), _strwidth(head2))
+    else: first = 0
+
+    for (tag, text1, text2) in linediff[first:]:
+        part1 = text1 if text1 is None else _strwidthcut(text1, room)
+        part2 = text2 if text2 is None else _strwidthcut(text2, room)
+        if part1 is text1 or len(part1) == len(text1):
+            if part2 is text2 or len(part2) == len(text2):
+                clipped.append((tag, text1, text2))
+                room -= max(_strwidth(text1 or ''), _strwidth(text2 or ''))
+                continue
+        # 幅に収まらなくなった箇所以降を省略する
+        if part1 or part2: clipped.append((tag, part1, part2))
+        clipped.append((' ', marker, marker))
+        break
+
+    return clipped
+
+
+# 差分の1行分を指定された幅に切り詰める
+def _truncate_record(text1, text2, linediff, width):
+    if linediff is not None:
+        linediff = _truncate_linediff(linediff, width)
+        text1 = ''.join([text for (tag, text, _) in linediff if text is not None])
+        text2 = ''.join([text for (tag, _, text) in linediff if text is not None])
+    else:
+        if text1 is not None: text1 = _truncate_text(text1.rstrip('\r\n'), width)
+        if text2 is not None: text2 = _truncate_text(text2.rstrip('\r\n'), width)
+    return (text1, text2, linediff)
+
+# 行の一致ブロックを検出するエンジン群
+# difflib.SequenceMatcherと同じインタフェース(get_opcodes, get_grouped_opcodes)を
+# 持たせるため、一致ブロックの検出部分(get_matching_blocks)のみを差し替える
+def _common_affix(a, alo, ahi, b, blo, bhi):
+    """Return the lengths of the common prefix and suffix of a[alo:ahi] and b[blo:bhi].
+
+    Example:
+
+    >>> _common_affix('abxyc', 0, 5, 'abzc', 0, 4)
+    (2, 1)
+    """
+    prefix = 0
+    while alo + prefix < ahi and blo + prefix < bhi and a[alo + prefix] == b[blo + prefix]:
+        prefix += 1
+    suffix = 0
+    while (alo + prefix < ahi - suffix and blo + prefix < bhi - suffix and
+           a[ahi - suffix - 1] == b[bhi - suffix - 1]):
+        suffix += 1
+    return prefix, suffix
+
+def _myers_split(a, alo, ahi, b, blo, bhi, budget=None):
+    # Myersの差分アルゴリズム(線形空間版)で中央のスネークを探し、分割点を返す
+    # 共通部分が無い場合はNoneを返す
+    # budgetが指定された場合は、編集距離を1つ進めるごとに調べる対角線の数を加算する
+    len1 = ahi - alo
+    len2 = bhi - blo
+    max_d = (len1 + len2 + 1) // 2
+    v_offset = max_d
+    v_length = 2 * max_d + 2
+    v1 = [-1] * v_length
+    v1[v_offset + 1] = 0
+    v2 = v1[:]
+    delta = len1 - len2
+    front = (delta % 2 != 0)
+    k1start = k1end = k2start = k2end = 0
+    for d in range(max_d):
+        if budget is not None: budget(2 * d + 2)
+        # 前方向に探索する
+        for k1 in range(-d + k1start, d + 1 - k1end, 2):
+            k1_offset = v_offset + k1
+            if k1 == -d or (k1 != d and v1[k1_offset - 1] < v1[k1_offset + 1]):
+                x1 = v1[k1_offset + 1]
+            else:
+                x1 = v1[k1_offset - 1] + 1
+            y1 = x1 - k1
+            while x1 < len1 and y1 < len2 and a[alo + x1] == b[blo + y1]:
+                x1 += 1
+                y1 += 1
+            v1[k1_offset] = x1
+            if x1 > len1:
+                k1end += 2
+            elif y1 > len2:
+                k1start += 2
+            elif front:
+                k2_offset = v_offset + delta - k1
+                if 0 <= k2_offset < v_length and v2[k2_offset] != -1:
+                    if x1 >= len1 - v2[k2_offset]:
+                        return alo + x1, blo + y1
+        # 後ろ方向に探索する
+        for k2 in range(-d + k2start, d + 1 - k2end, 2):
+            k2_offset = v_offset + k2
+            if k2 == -d or (k2 != d and v2[k2_offset - 1] < v2[k2_offset + 1]):
+                x2 = v2[k2_offset + 1]
+            else:
+                x2 = v2[k2_offset - 1] + 1
+            y2 = x2 - k2
+            while x2 < len1 and y2 < len2 and a[ahi - x2 - 1] == b[bhi - y2 - 1]:
+                x2 += 1
+                y2 += 1
+            v2[k2_offset] = x2
+            if x2 > len1:
+                k2end += 2
+            elif y2 > len2:
+                k2start += 2
+            elif not front:
+                k1_offset = v_offset + delta - k2
+                if 0 <= k1_offset < v_length and v1[k1_offset] != -1:
+                    x1 = v1[k1_offset]
+                    y1 = v_offset + x1 - k1_offset
+                    if x1 >= len1 - x2:
+                        return alo + x1, blo + y1
+    return None
+
+def _myers_blocks(a, alo, ahi, b, blo, bhi, blocks, isjunk=None, budget=None):
+    # 再帰の代わりにキューを使って分割統治する
+    queue = [(alo, ahi, blo, bhi)]
+    while queue:
+        alo, ahi, blo, bhi = queue.pop()
+        prefix, suffix = _common_affix(a, alo, ahi, b, blo, bhi)
+        if prefix:
+            blocks.append((alo, blo, prefix))
+        if suffix:
+            blocks.append((ahi - suffix, bhi - suffix, suffix))
+        alo += prefix
+        blo += prefix
+        ahi -= suffix
+        bhi -= suffix
+        if alo >= ahi or blo >= bhi:
+            continue
+        split = _myers_split(a, alo, ahi, b, blo, bhi, budget)
+        if split is None:
+            continue
+        x, y = split
+        if (x, y) in ((alo, blo), (ahi, bhi)):
+            continue
+        queue.append((alo, x, blo, y))
+        queue.append((x, ahi, y, bhi))
+    return blocks
+
+def _patience_blocks(a, alo, ahi, b, blo, bhi, blocks, isjunk=None, budget=None):
+    queue = [(alo, ahi, blo, bhi)]
+    while queue:
+        alo, ahi, blo, bhi = queue.pop()
+        prefix, suffix = _common_affix(a, alo, ahi, b, blo, bhi)
+        if prefix:
+            blocks.append((alo, blo, prefix))
+        if suffix:
+            blocks.append((ahi - suffix, bhi - suffix, suffix))
+        alo += prefix
+        blo += prefix
+        ahi -= suffix
+        bhi -= suffix
+        if alo >= ahi or blo >= bhi:
+            continue
+        if budget is not None: budget((ahi - alo) + (bhi - blo))
+
+        # 両方のシーケンスでちょうど1回だけ現れるitemをアンカーの候補とする
+        counts = {}
+        for i in range(alo, ahi):
+            item = a[i]
+            if item in counts:
+                counts[item][0] += 1
+            else:
+                counts[item] = [1, i, 0, None]
+        for j in range(blo, bhi):
+            count = counts.get(b[j])
+            if count is not None:
+                count[2] += 1
+                count[3] = j
+        pairs = sorted((count[1], count[3]) for item, count in counts.items()
+                       if count[0] == 1 and count[2] == 1
+                       and not (isjunk is not None and isjunk(item)))
+
+        # 忍耐ソートで最長増加部分列を求め、アンカーとする
+        tails = []
+        tails_j = []
+        backpointers = []
+        for index, (i, j) in enumerate(pairs):
+            pos = bisect.bisect_left(tails_j, j)
+            backpointers.append(tails[pos - 1] if pos > 0 else -1)
+            if pos == len(tails):
+                tails.append(index)
+                tails_j.append(j)
+            else:
+                tails[pos] = index
+                tails_j[pos] = j
+        if not tails:
+            # アンカーが無い場合はMyersのアルゴリズムにまかせる
+            _myers_blocks(a, alo, ahi, b, blo, bhi, blocks, budget=budget)
+            continue
+        anchors = []
+        index = tails[-1]
+        while index != -1:
+            anchors.append(pairs[index])
+            index = backpointers[index]
+        anchors.reverse()
+
+        i1, j1 = alo, blo
+        for i, j in anchors:
+            blocks.append((i, j, 1))
+            queue.append((i1, i, j1, j))
+            i1, j1 = i + 1, j + 1
+        queue.append((i1, ahi, j1, bhi))
+    return blocks
+
+# histogramアルゴリズムで候補とする出現回数の上限
+_HISTOGRAM_MAX_CHAIN = 64
+
+def _histogram_blocks(a, alo, ahi, b, blo, bhi, blocks, isjunk=None, budget=None):
+    queue = [(alo, ahi, blo, bhi)]
+    while queue:
+        alo, ahi, blo, bhi = queue.pop()
+        prefix, suffix = _common_affix(a, alo, ahi, b, blo, bhi)
+        if prefix:
+            blocks.append((alo, blo, prefix))
+        if suffix:
+            blocks.append((ahi - suffix, bhi - suffix, suffix))
+        alo += prefix
+        blo += prefix
+        ahi -= suffix
+        bhi -= suffix
+        if alo >= ahi or blo >= bhi:
+            continue
+        if budget is not None: budget((ahi - alo) + (bhi - blo))
+
+        # seq1側の出現位置の一覧(ヒストグラム)を作る
+        occurrences = {}
+        for i in range(alo, ahi):
+            occurrences.setdefault(a[i], []).append(i)
+
+        # 出現回数がもっとも少ないitemを含む一致区間を探す
+        best = None
+        lowcount = _HISTOGRAM_MAX_CHAIN + 1
+        j = blo
+        while j < bhi:
+            item = b[j]
+            positions = occurrences.get(item)
+            next_j = j + 1
+            if (positions is None or len(positions) > lowcount or
+                (isjunk is not None and isjunk(item))):
+                j = next_j
+                continue
+            for i in positions:
+                si, sj = i, j
+                while si > alo and sj > blo and a[si - 1] == b[sj - 1]:
+                    si -= 1
+                    sj -= 1
+                ei, ej = i + 1, j + 1
+                while ei < ahi and ej < bhi and a[ei] == b[ej]:
+                    ei += 1
+                    ej += 1
+                next_j = max(next_j, ej)
+                count = min(len(occurrences[a[x]]) for x in range(si, ei))
+                if best is None or ei - si > best[2] or count < lowcount:
+                    best = (si, sj, ei - si)
+                    lowcount = count
+            j = next_j
+
+        if best is None:
+            # 候補が無い場合はMyersのアルゴリズムにまかせる
+            _myers_blocks(a, alo, ahi, b, blo, bhi, blocks, budget=budget)
+            continue
+        i, j, k = best
+        blocks.append(best)
+        queue.append((alo, i, blo, j))
+        queue.append((i + k, ahi, j + k, bhi))
+    return blocks
+
+# 一致ブロックの検出の途中で、比較の手数の上限もしくは期限を超えたことを知らせる例外
+class _BudgetExceeded(Exception):
+    pass
+
+# difflibのエンジン
+# 一致ブロックの検出は変えずに、最長一致を探すごとにbudgetに手数を加算する
+class _DifflibMatcher(difflib.SequenceMatcher):
+    r"""difflib.SequenceMatcher that reports its work to budget, if set.
+
+    budget is called with the number of items of each range searched for
+    the longest match, and may raise _BudgetExceeded to stop matching.
+    """
+
+    budget = None
+
+    def find_longest_match(self, alo=0, ahi=None, blo=0, bhi=None):
+        if ahi is None: ahi = len(self.a)
+        if bhi is None: bhi = len(self.b)
+        if self.budget is not None: self.budget((ahi - alo) + (bhi - blo))
+        return difflib.SequenceMatcher.find_longest_match(self, alo, ahi, blo, bhi)
+
+class _LineMatcher(difflib.SequenceMatcher):
+    r"""Base class of the line matching engines other than difflib.
+
+    Only get_matching_blocks() is replaced, so get_opcodes() and
+    get_grouped_opcodes() behave exactly as the ones of SequenceMatcher.
+    isjunk items are never used as anchors (myers ignores isjunk).
+    budget, if set, is called with the amount of work of each step (like
+    _DifflibMatcher).
+    """
+
+    _find_blocks = None
+    budget = None
+
+    def __init__(self, isjunk=None, a='', b='', autojunk=True):
+        self.isjunk = isjunk
+        self.a = self.b = None
+        self.set_seqs(a, b)
+
+    def set_seq1(self, a):
+        if a is self.a: return
+        self.a = a
+        self.matching_blocks = self.opcodes = None
+
+    def set_seq2(self, b):
+        if b is self.b: return
+        self.b = b
+        self.matching_blocks = self.opcodes = None
+        self.fullbcount = None
+
+    def get_matching_blocks(self):
+        if self.matching_blocks is not None:
+            return self.matching_blocks
+        la, lb = len(self.a), len(self.b)
+        matching_blocks = self._find_blocks(self.a, 0, la, self.b, 0, lb, [],
+                                            self.isjunk, self.budget)
+        matching_blocks.sort()
+
+        # 隣接する一致ブロックをまとめる
+        i1 = j1 = k1 = 0
+        non_adjacent = []
+        for i2, j2, k2 in matching_blocks:
+            if i1 + k1 == i2 and j1 + k1 == j2:
+                k1 += k2
+            else:
+                if k1:
+                    non_adjacent.append((i1, j1, k1))
+                i1, j1, k1 = i2, j2, k2
+        if k1:
+            non_adjacent.append((i1, j1, k1))
+        non_adjacent.append((la, lb, 0))
+        self.matching_blocks = [difflib.Match._make(block) for block in non_adjacent]
+        return self.matching_blocks
+
+class _MyersMatcher(_LineMatcher):
+    r"""
+    Example:
+
+    >>> import pprint
+    >>> pprint.pprint(_MyersMatcher(None, 'abcabba', 'cbabac').get_opcodes())
+    [('replace', 0, 1, 0, 1),
+     ('equal', 1, 2, 1, 2),
+     ('delete', 2, 3, 2, 2),
+     ('equal', 3, 5, 2, 4),
+     ('delete', 5, 6, 4, 4),
+     ('equal', 6, 7, 4, 5),
+     ('insert', 7, 7, 5, 6)]
+    """
+    _find_blocks = staticmethod(_myers_blocks)
+
+class _PatienceMatcher(_LineMatcher):
+    r"""
+    Example:
+
+    >>> _PatienceMatcher(None, ['a', '{', 'x', '}', 'b'], ['a', '{', 'y', '}', '{', 'x', '}', 'b']).get_opcodes()
+    [('equal', 0, 2, 0, 2), ('insert', 2, 2, 2, 5), ('equal', 2, 5, 5, 8)]
+    """
+    _find_blocks = staticmethod(_patience_blocks)
+
+class _HistogramMatcher(_LineMatcher):
+    r"""
+    Example:
+
+    >>> _HistogramMatcher(None, ['a', '{', 'x', '}', 'b'], ['a', '{', 'y', '}', '{', 'x', '}', 'b']).get_opcodes()
+    [('equal', 0, 2, 0, 2), ('insert', 2, 2, 2, 5), ('equal', 2, 5, 5, 8)]
+    """
+    _find_blocks = staticmethod(_histogram_blocks)
+
+# 行の一致ブロックを検出するエンジン(Differのengine、--algorithmで指定する)
+_engines = {
+    'difflib': _DifflibMatcher,
+    'myers': _MyersMatcher,
+    'patience': _PatienceMatcher,
+    'histogram': _HistogramMatcher,
+    }
+
+# エンジンが最初に先頭と末尾の共通部分を取り除くか（取り除いても結果が変わらないか）を返す
+def _engine_trims_affix(engine):
+    return issubclass(_engines[engine], _LineMatcher)
 
-    return array
 
+# difflib.SequenceMatcher.get_grouped_opcodes()と同じ方法で
+# opcodesを前後n個のコンテキストを持つグループに分ける
+def _group_opcodes(codes, n=3):
+    r"""Isolate change clusters of opcodes; return a generator of groups.
+
+    Example:
+
+    >>> codes = [('equal', 0, 10, 0, 10), ('replace', 10, 11, 10, 11),
+    ...          ('equal', 11, 30, 11, 30), ('delete', 30, 31, 30, 30)]
+    >>> import pprint
+    >>> pprint.pprint(list(_group_opcodes(codes, 2)), width=100)
+    [[('equal', 8, 10, 8, 10), ('replace', 10, 11, 10, 11), ('equal', 11, 13, 11, 13)],
+     [('equal', 28, 30, 28, 30), ('delete', 30, 31, 30, 30)]]
+    """
+    codes = list(codes)
+    if not codes:
+        codes = [('equal', 0, 1, 0, 1)]
+    # Fixup leading and trailing groups if they show no changes.
+    if codes[0][0] == 'equal':
+        tag, i1, i2, j1, j2 = codes[0]
+        codes[0] = tag, max(i1, i2 - n), i2, max(j1, j2 - n), j2
+    if codes[-1][0] == 'equal':
+        tag, i1, i2, j1, j2 = codes[-1]
+        codes[-1] = tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)
+
+    nn = n + n
+    group = []
+    for tag, i1, i2, j1, j2 in codes:
+        # End the current group and start a new one whenever
+        # there is a large range with no changes.
+        if tag == 'equal' and i2 - i1 > nn:
+            group.append((tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)))
+            yield group
+            group = []
+            i1, j1 = max(i1, i2 - n), max(j1, j2 - n)
+        group.append((tag, i1, i2, j1, j2))
+    if group and not (len(group) == 1 and group[0][0] == 'equal'):
+        yield group
+
+# 順に届くopcodeに対して_group_opcodesと同じグループ化を行い、
+# compareと同じTrue/False/None付きの出力に変換する
+# 一致の連続はコンテキストの行数分だけを保持するので、入力の大きさによらずメモリは一定
+class _ContextStream:
+    r"""Group records of opcodes arriving in order, like _group_opcodes.
+
+    Example:
+
+    >>> stream = _ContextStream(1)
+    >>> out = []
+    >>> for num in range(3):
+    ...     out += stream.equal(((' ', num, 'a', num, 'a'), None))
+    >>> out += stream.change()
+    >>> out += stream.equal(((' ', 4, 'b', 4, 'b'), None))
+    >>> out += stream.finish()
+    >>> out
+    [None, True, ((' ', 2, 'a', 2, 'a'), None), False, True, ((' ', 4, 'b', 4, 'b'), None), False]
+    """
+
+    def __init__(self, context):
+        self.context = context
+        self.first = True
+        self.in_run = False
+        self.run_len = 0
+        self.tail = None
+
+    def equal(self, record):
+        out = []
+        if not self.in_run:
+            self.in_run = True
+            self.run_len = 0
+            self.tail = collections.deque(maxlen=self.context or 0)
+            if self.context is None or not self.first:
+                out.append(True)
+        self.run_len += 1
+        # 先頭のコンテキストはすぐに出力し、それ以降は末尾のコンテキストとして保持する
+        if self.context is None or (not self.first and self.run_len <= self.context):
+            out.append(record)
+        else:
+            self.tail.append(record)
+        return out
+
+    def change(self):
+        out = self._end_run(final=False)
+        self.first = False
+        return out
+
+    def finish(self):
+        return self._end_run(final=True)
+
+    def _end_run(self, final):
+        if not self.in_run: return []
+        self.in_run = False
+        n = self.context
+        out = []
+        if n is None:
+            out.append(False)
+        elif self.first:
+            # 入力全体が一致している場合は何も出力しない
+            if not final:
+                if self.run_len > n: out.append(None)
+                out.append(True)
+                out.extend(self.tail)
+                out.append(False)
+        elif final:
+            out.append(False)
+            if self.run_len > n: out.append(None)
+        elif self.run_len <= n + n:
+            out.extend(self.tail)
+            out.append(False)
+        else:
+            out.extend((False, None, True))
+            out.extend(self.tail)
+            out.append(False)
+        self.tail = None
+        return out
+
+# 行(item)ごとに小さな整数を割り当て、整数の配列に変換する
+# 一致ブロックの検出はこの配列に対して行い、元のitemは出力と行内差分にのみ使用する
+def _intern(seq1, seq2, raw=False, trim=False):
+    r"""Map each distinct item to a small int; return two int arrays and the items.
+
+    Example:
+
+    >>> tokens1, tokens2, items = _intern(['a', 'b', 'a'], ['b', 'c'])
+    >>> [items[token] for token in tokens1], [items[token] for token in tokens2]
+    (['a', 'b', 'a'], ['b', 'c'])
+    >>> sorted(items)
+    ['a', 'b', 'c']
+    """
+    # 同じエンコーディングのMappedLines同士は、デコードせずに生のバイト列で一致を判定する
+    # （その場合のitemsはバイト列なので、itemsを参照しない場合に限る）
+    if raw and _is_raw_comparable(seq1, seq2):
+        return _intern_mapped(seq1, seq2, trim)
+
+    table = dict.fromkeys(itertools.chain(seq1, seq2))
+    items = list(table)
+    for token, item in enumerate(items):
+        table[item] = token
+    tokens1 = array('i', map(table.__getitem__, seq1))
+    tokens2 = array('i', map(table.__getitem__, seq2))
+    return tokens1, tokens2, items
+
+# 2つのバイト列の先頭から(tail=Trueの場合は末尾から)一致する長さを返す
+# 大きな塊ごとに比較し、一致しない塊の中を二分探索する
+def _common_bytes(data1, data2, tail=False, chunk=1 << 20):
+    r"""Give back the length of the common head (or tail) of two byte strings.
+
+    Example:
+
+    >>> _common_bytes(b'abcdef', b'abcxef', chunk=2), _common_bytes(b'abcdef', b'abcxef', tail=True)
+    (3, 2)
+    """
+    size = min(len(data1), len(data2))
+    if tail:
+        end1 = len(data1)
+        end2 = len(data2)
+        same = lambda low, high: data1[end1 - high:end1 - low] == data2[end2 - high:end2 - low]
+    else:
+        same = lambda low, high: data1[low:high] == data2[low:high]
+    pos = 0
+    while pos < size:
+        end = min(pos + chunk, size)
+        if not same(pos, end):
+            while end - pos > 1:
+                mid = (pos + end) // 2
+                if same(pos, mid): pos = mid
+                else: end = mid
+            return pos
+        pos = end
+    return size
+
+# MappedLines同士の先頭と末尾で一致している行数を、バイト列の比較で求める
+# 行末を取り除く場合はバイト列の一致と行の一致が食い違うので求めない
+def _common_mapped_lines(seq1, seq2):
+    if seq1.strip_eol: return 0, 0
+    starts1, starts2 = seq1._starts, seq2._starts
+    size1, size2 = len(seq1), len(seq2)
+
+    offset = _common_bytes(seq1._data, seq2._data)
+    head = min(bisect.bisect_right(starts1, offset) - 1, size1, size2)
+    # 最後の行は改行の有無で長さが異なることがある
+    if head > 0 and starts1[head] != starts2[head]: head -= 1
+
+    length = _common_bytes(seq1._data, seq2._data, tail=True)
+    limit = min(size1, size2) - head
+    tail = 0
+    while (tail < limit and
+           starts1[-1] - starts1[size1 - tail - 1] <= length and
+           starts1[-1] - starts1[size1 - tail - 1] == starts2[-1] - starts2[size2 - tail - 1]):
+        tail += 1
+    return head, tail
+
+# MappedLines同士の行を整数に置き換える（デコードせずに生のバイト列を鍵とする）
+# trimの場合、先頭と末尾で一致している行は比較するまでもないので、すべてトークン0とし表に加えない
+# （エンジンが先頭と末尾の共通部分を取り除く場合に限る。_get_opcodesを参照）
+def _intern_mapped(seq1, seq2, trim=False):
+    r"""Map each distinct raw line of two MappedLines to a small int (see _intern).
+
+    With trim, lines in the common head and tail all share token 0.
+    """
+    head, tail = _common_mapped_lines(seq1, seq2) if trim else (0, 0)
+    table = {None: 0}
+    result = []
+    for seq in (seq1, seq2):
+        raw = seq.raw
+        tokens = array('i', [0]) * head
+        tokens.extend(table.setdefault(raw(index), len(table))
+                      for index in range(head, len(seq) - tail))
+        tokens.extend(array('i', [0]) * tail)
+        result.append(tokens)
+    return result[0], result[1], list(table)
+
+# 置き換えブロック内の類似itemの候補を絞り込むためのn-gramインデックス
+class _CandidateIndex:
+    r"""N-gram index over the seq1 side of a replace block.
+
+    Only used by Differ._fancy_replace() when a (sub)block has more
+    items than Differ.candidates; it returns the seq1 positions that share
+    the most n-grams with an item of seq2.
+
+    Example:
+
+    >>> seq1 = ['apple pie', 'banana split', 'cherry tart', 'apple pie']
+    >>> index = _CandidateIndex(seq1, 0, 4, limit=1)
+    >>> index.candidates(0, 'banana splits', 0, 4)
+    [1]
+    >>> index.equal('apple pie', 1, 4)
+    3
+    """
+
+    def __init__(self, seq, low, high, limit, n=3):
+        self.limit = limit
+        self.n = n
+        self.grams_cache = {}
+        postings = {}
+        positions = {}
+        for pos in range(low, high):
+            item = seq[pos]
+            positions.setdefault(item, []).append(pos)
+            for gram in self.grams(item):
+                postings.setdefault(gram, []).append(pos)
+        # 多くのitemに現れるn-gramは候補の絞り込みに役立たないので除く
+        popular = 4 * limit
+        self.postings = dict((gram, poslist) for gram, poslist in postings.items()
+                             if len(poslist) <= popular)
+        self.positions = positions
+
+    def grams(self, item):
+        n = self.n
+        try:
+            size = len(item)
+            item[0:n]
+        except TypeError:
+            item = tuple(item)
+            size = len(item)
+        if size <= n:
+            return set([item])
+        return set(item[k:k + n] for k in range(size - n + 1))
+
+    def equal(self, item, low, high):
+        # low <= pos < high の範囲で最初に完全一致するitemの位置を返す
+        poslist = self.positions.get(item)
+        if poslist is None:
+            return None
+        i = bisect.bisect_left(poslist, low)
+        if i < len(poslist) and poslist[i] < high:
+            return poslist[i]
+        return None
+
+    def candidates(self, key, item, low, high):
+        # 共有するn-gramの多い順にlimit個の位置を選び、位置の昇順で返す
+        grams = self.grams_cache.get(key)
+        if grams is None:
+            grams = self.grams_cache[key] = self.grams(item)
+        counts = {}
+        for gram in grams:
+            poslist = self.postings.get(gram)
+            if poslist is None:
+                continue
+            for i in range(bisect.bisect_left(poslist, low), len(poslist)):
+                pos = poslist[i]
+                if pos >= high: break
+                counts[pos] = counts.get(pos, 0) + 1
+        best = heapq.nsmallest(self.limit, counts, key=lambda pos: (-counts[pos], pos))
+        return sorted(best)
+
+
+# 変更チェンジセットのitemがすべてiterableであるか（行内差分を取得できるか）を返す
+def _is_iterable_block(seq1, seq1_low, seq1_high, seq2, seq2_low, seq2_high):
+    try:
+        for num1 in range(seq1_low, seq1_high): iter(seq1[num1])
+        for num2 in range(seq2_low, seq2_high): iter(seq2[num2])
+    except TypeError:
+        return False
+    return True
+
+# プロセスプールで変更チェンジセットの行内差分を取得する
+# （pickle可能であるようにモジュールのトップレベルに定義する）
+def _fancy_replace_worker(options, seq1, offset1, seq2, offset2):
+    differ = Differ(**options)
+    records = []
+    for ((tag, num1, text1, num2, text2), linediff) in differ._fancy_replace(
+            seq1, 0, len(seq1), seq2, 0, len(seq2)):
+        if num1 is not None: num1 += offset1
+        if num2 is not None: num2 += offset2
+        records.append(((tag, num1, text1, num2, text2), linediff))
+    degraded = [(seq1_low + offset1, seq1_high + offset1,
+                 seq2_low + offset2, seq2_high + offset2)
+                for (seq1_low, seq1_high, seq2_low, seq2_high) in differ.degraded]
+    return records, degraded
+
+CacheInfo = collections.namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+# 一致したitemの連続をまとめた範囲（Differ(equal_ranges=True)の場合にcompareが返す）
+EqualRange = collections.namedtuple('EqualRange', ['tag', 'lo1', 'hi1', 'lo2', 'hi2'])
+
+def expand_equal_ranges(diffs, seq1, seq2):
+    r"""
+    Expand EqualRange in the output of Differ.compare into per-item tuples (lazily).
+
+    Example:
+
+    >>> list(expand_equal_ranges([True, EqualRange(' ', 0, 2, 1, 3), False], 'ab', 'xab'))
+    [True, ((' ', 0, 'a', 1, 'a'), None), ((' ', 1, 'b', 2, 'b'), None), False]
+    """
+    for diff in diffs:
+        if isinstance(diff, EqualRange):
+            for num1, num2 in zip(range(diff.lo1, diff.hi1), range(diff.lo2, diff.hi2)):
+                yield ((' ', num1, seq1[num1], num2, seq2[num2]), None)
+        else:
+            yield diff
+
+# compareの結果を省メモリに保持するコンテナ
+# 1件ごとのタプルを作らず、種別をbytearrayに、インデックスをarrayに格納し、
+# itemは元のシーケンスを参照する（行内差分のみ疎な辞書で保持する）
+class DiffArray:
+    r"""Compact sequence of the output of Differ.compare (struct of arrays).
+
+    Items are not copied; they are looked up in seq1 and seq2 on access.
+
+    Example:
+
+    >>> diffs = DiffArray([1, 2, 3], [1, 5, 3], Differ().compare([1, 2, 3], [1, 5, 3]))
+    >>> len(diffs)
+    9
+    >>> diffs[4], diffs[-1]
+    ((('|', 1, 2, 1, 5), None), False)
+    >>> list(diffs) == list(Differ().compare([1, 2, 3], [1, 5, 3]))
+    True
+    >>> diffs[-10]
+    Traceback (most recent call last):
+        ...
+    IndexError: DiffArray index out of range
+    >>> diffs.summary() == {'<': 0, '>': 0, ' ': 2, '|': 1}
+    True
+    """
+
+    __slots__ = ('seq1', 'seq2', 'kinds', 'nums1', 'nums2', 'linediffs', 'highs')
+
+    _markers = {True: ord('T'), False: ord('F'), None: ord('N')}
+    _values = {ord('T'): True, ord('F'): False, ord('N'): None}
+
+    def __init__(self, seq1, seq2, diffs=()):
+        self.seq1 = seq1
+        self.seq2 = seq2
+        self.kinds = bytearray()
+        self.nums1 = array('l')
+        self.nums2 = array('l')
+        # 行内差分とEqualRangeの終端は該当する位置だけを辞書で持つ
+        self.linediffs = {}
+        self.highs = {}
+        self.extend(diffs)
+
+    def extend(self, diffs):
+        kinds, nums1, nums2 = self.kinds, self.nums1, self.nums2
+        for diff in diffs:
+            if diff is True or diff is False or diff is None:
+                kinds.append(self._markers[diff])
+                nums1.append(-1)
+                nums2.append(-1)
+            elif isinstance(diff, EqualRange):
+                self.highs[len(kinds)] = (diff.hi1, diff.hi2)
+                kinds.append(ord('='))
+                nums1.append(diff.lo1)
+                nums2.append(diff.lo2)
+            else:
+                ((tag, num1, item1, num2, item2), linediff) = diff
+                if linediff is not None: self.linediffs[len(kinds)] = linediff
+                kinds.append(ord(tag))
+                nums1.append(-1 if num1 is None else num1)
+                nums2.append(-1 if num2 is None else num2)
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0: index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('DiffArray index out of range')
+        kind = self.kinds[index]
+        if kind in self._values: return self._values[kind]
+        num1 = self.nums1[index]
+        num2 = self.nums2[index]
+        if kind == ord('='):
+            (hi1, hi2) = self.highs[index]
+            return EqualRange(' ', num1, hi1, num2, hi2)
+        if num1 < 0: num1 = item1 = None
+        else: item1 = self.seq1[num1]
+        if num2 < 0: num2 = item2 = None
+        else: item2 = self.seq2[num2]
+        return ((chr(kind), num1, item1, num2, item2), self.linediffs.get(index))
+
+    def __iter__(self):
+        for index in range(len(self.kinds)):
+            yield self[index]
+
+    def summary(self):
+        """Count items by code, without building the records."""
+        counts = dict((code, 0) for code in '<> |')
+        for code in '<>|':
+            counts[code] = self.kinds.count(bytearray([ord(code)]))
+        counts[' '] = (self.kinds.count(bytearray([ord(' ')])) +
+                       sum(hi1 - self.nums1[index]
+                           for index, (hi1, hi2) in self.highs.items()))
+        return counts
+
+# 行のペアのマッチ率と行内差分を記憶する、大きさに上限のあるLRUキャッシュ
+# 値は[正確なマッチ率, 行内差分 | None]
+# （quick_ratioなどの上限値で弾かれたペアは記憶しない）
+class _SimilarityCache:
+    r"""LRU cache of the similarity of item pairs, shared across comparisons.
+
+    Example:
+
+    >>> cache = _SimilarityCache(maxsize=2)
+    >>> cache.put(('a', 'b'), [0.5, None])
+    >>> cache.get(('a', 'b'))
+    [0.5, None]
+    >>> cache.get(('a', 'c')) is None
+    True
+    >>> cache.put(('a', 'c'), [0.5, None])
+    >>> cache.put(('a', 'd'), [0.5, None])
+    >>> cache.get(('a', 'b')) is None
+    True
+    >>> cache.info()
+    CacheInfo(hits=1, misses=2, maxsize=2, currsize=2)
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        try:
+            entry = self.data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        self.data[key] = entry
+        self.hits += 1
+        return entry
+
+    def put(self, key, entry):
+        self.data.pop(key, None)
+        self.data[key] = entry
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def info(self):
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self.data))
 
 # テキスト差分取得クラス
 # 内部処理にdifflibのSequenceMatcherクラスを使用している
@@ -332,20 +1570,123 @@ class Differ:
     #   * context
     #      差分をコンテキストで取得するか、その場合の前後行の数を指定する。
     #      差分をすべてフルで出力する場合はNoneを指定する。
+    #   * engine
+    #      行の一致ブロックを検出するエンジンを指定する。
+    #      'difflib'(SequenceMatcher), 'myers', 'patience', 'histogram'のいずれか。
+    #      巨大な入力や繰り返しの多い入力では'difflib'以外が高速になる。
+    #   * candidates
+    #      変更チェンジセット内で類似itemを探す際に、1つのitemに対して
+    #      マッチ率を計算する相手の数の上限。
+    #      チェンジセットの大きさがこれを超える場合に限り、n-gramのインデックスで
+    #      類似していそうな相手だけに絞り込む。Noneの場合は絞り込まない。
+    #      絞り込む場合は、各段でseq2の先頭からcandidates個以上を調べて類似した
+    #      ペアが見つかればそこを同期点とするため、チェンジセット全体で
+    #      最も類似したペアが選ばれるとは限らない。1以上を指定する。
+    #   * max_cost, deadline
+    #      1回のcompareのコストの上限。deadlineは経過秒数で指定する。
+    #      max_costは比較の手数で、一致ブロックの検出では調べたitemの数、
+    #      行内差分の相手を探す際にはペア1組につき1（マッチ率や行内差分を
+    #      計算する場合は、さらにそのペアの文字数）を数える。
+    #      上限は一致ブロックの検出、マッチ率の計算、行内差分の計算のそれぞれの
+    #      手前で判定する（1つのペアのratio()の途中では打ち切らない）。
+    #      一致ブロックの検出で超えた場合は、先頭と末尾の共通部分を除いた全体が、
+    #      行内差分の相手を探す際に超えた場合は、残りの変更チェンジセットが
+    #      単純な置き換え（'<'の後に'>'）として出力され、その範囲はdegradedに記録される。
+    #   * workers
+    #      変更チェンジセットの行内差分をプロセスプールで並列に処理する場合のプロセス数。
+    #      この場合、charjunkおよびitemはpickle可能である必要があり、
+    #      max_costは変更チェンジセットごとの上限となる。
+    #   * cache_size
+    #      行のペアの正確なマッチ率と行内差分をキャッシュする数。
+    #      quick_ratioなどの上限値で弾かれたペアはキャッシュしない。
+    #      キャッシュはインスタンスに保持され、複数回のcompareで共有される。
+    #      Noneまたは0の場合はキャッシュしない。負の数は指定できない。
+    #   * theme
+    #      色付き表示に使うThemeオブジェクト。Noneの場合は標準の配色を使う。
+    #   * equal_ranges
+    #      Trueの場合、一致したitemの連続を1行ずつではなく
+    #      EqualRange(' ', lo1, hi1, lo2, hi2)として1つにまとめて返す。
     def __init__(self, linejunk=None, charjunk=None, cutoff=0.75, fuzzy=0.0,
-                 cutoffchar=False, context=3):
+                 cutoffchar=False, context=3, engine='difflib', candidates=None,
+                 max_cost=None, deadline=None, workers=None, cache_size=None,
+                 theme=None, equal_ranges=False):
         """Construct a text differencer, with options.
 
         """
 
+        if engine not in _engines:
+            raise ValueError('unknown engine \'' + str(engine) + '\'')
+        if cache_size is not None and cache_size < 0:
+            raise ValueError('cache_size must not be negative')
+        if candidates is not None and candidates < 1:
+            raise ValueError('candidates must be positive')
+
         self.linejunk = linejunk
         self.charjunk = charjunk
         self.cutoff = cutoff
         self.fuzzy = fuzzy
         self.cutoffchar = cutoffchar
         self.context = context
+        self.engine = engine
+        self.candidates = candidates
+        self.max_cost = max_cost
+        self.deadline = deadline
+        self.workers = workers
+        self.cache = _SimilarityCache(cache_size) if cache_size else None # 0は無効
+        self.theme = theme if theme is not None else _default_theme
+        self.equal_ranges = equal_ranges
+        self._reset_budget()
         return
 
+    def compare_array(self, seq1, seq2):
+        r"""
+        Compare two sequences; return the whole result as a compact DiffArray.
+
+        Example:
+
+        >>> diffs = Differ(equal_ranges=True).compare_array('abc', 'abd')
+        >>> diffs[1]
+        EqualRange(tag=' ', lo1=0, hi1=2, lo2=0, hi2=2)
+        """
+        return DiffArray(seq1, seq2, self.compare(seq1, seq2))
+
+    def cache_info(self):
+        r"""
+        Return hits, misses, maxsize and currsize of the similarity cache.
+
+        Example:
+
+        >>> differ = Differ(cache_size=100)
+        >>> diff = list(differ.compare(['three\n'], ['tree\n']))
+        >>> diff = list(differ.compare(['three\n'], ['tree\n']))
+        >>> differ.cache_info()
+        CacheInfo(hits=3, misses=1, maxsize=100, currsize=1)
+        >>> Differ(cache_size=0).cache is None
+        True
+        """
+        if self.cache is None:
+            return CacheInfo(0, 0, 0, 0)
+        return self.cache.info()
+
+    def _reset_budget(self):
+        self.cost = 0
+        self.degraded = []
+        self._started = _clock()
+
+    # コストの上限もしくは期限を超えているかを返す
+    def _over_budget(self):
+        if self.max_cost is not None and self.cost > self.max_cost:
+            return True
+        if self.deadline is not None and _clock() - self._started > self.deadline:
+            return True
+        return False
+
+    # 一致ブロックの検出の手数を加算し、上限もしくは期限を超えた場合は
+    # _BudgetExceededを送出する（エンジンのbudgetとして渡す）
+    def _charge(self, cost):
+        self.cost += cost
+        if self._over_budget(): raise _BudgetExceeded()
+
     # 2つのテキストの差分を取得する
     def compare(self, seq1, seq2):
         r"""
@@ -353,7 +1694,7 @@ class Differ:
 
         Requirement is
 
-        * both sequences must be iterable (no generator).
+        * both sequences must be iterable (no generator; see compare_iter for generators).
         * items in a sequence must be (recursively) hashable.
 
         If the items of a sequences are iterable, detect similar ones as needed.
@@ -465,6 +1806,8 @@ class Differ:
         +------------+--------------------------------------------------------------------------------------------+
         | Tuple      | ((Code, Index1 | None, Item1 | None, Index2 | None, Item2 | None), InlineDiff | None)      |
         +------------+--------------------------------------------------------------------------------------------+
+        | EqualRange | (" ", Index1 low, Index1 high, Index2 low, Index2 high) (only if equal_ranges is True)     |
+        +------------+--------------------------------------------------------------------------------------------+
 
         +------------+------------------------------------+
         | Code       | Meaning                            |
@@ -498,20 +1841,187 @@ class Differ:
         | "!"        | different to both inline sequences (item of sequences) |
         +------------+--------------------------------------------------------+
 
+        If max_cost or deadline is exceeded, the remaining replace blocks are
+        output without synching similar items, and their ranges
+        (Index1 low, Index1 high, Index2 low, Index2 high) are listed in degraded.
+        If it is exceeded while matching lines, all but the common head and
+        tail becomes one such block.
+
+        >>> differ = Differ(cutoff=0, max_cost=0)
+        >>> pprint.pprint(list(differ.compare(['one', 'two'], ['ore', 'tree'])))
+        [True,
+         (('<', 0, 'one', None, None), None),
+         (('<', 1, 'two', None, None), None),
+         (('>', None, None, 0, 'ore'), None),
+         (('>', None, None, 1, 'tree'), None),
+         False]
+        >>> differ.degraded
+        [(0, 2, 0, 2)]
+
+        If equal_ranges is True, each run of common items is output as one EqualRange
+        (see expand_equal_ranges).
+
+        >>> pprint.pprint(list(Differ(equal_ranges=True).compare([1, 2, 3, 4], [1, 2, 3, 5])))
+        [True,
+         EqualRange(tag=' ', lo1=0, hi1=3, lo2=0, hi2=3),
+         False,
+         True,
+         (('|', 3, 4, 3, 5), None),
+         False]
+
         """
 
-        # SequenceMatcherのインスタンスを生成する
-        cruncher = difflib.SequenceMatcher(self.linejunk, seq1, seq2)
+        self._reset_budget()
+
+        # itemを整数に置き換えてから一致ブロックを検出する
+        # （ハッシュ値の計算と比較のコストを減らし、エンジン内部のテーブルを小さくする）
+        tokens1, tokens2, items = _intern(seq1, seq2, raw=self.linejunk is None,
+                                          trim=_engine_trims_affix(self.engine))
+        if self.linejunk is not None:
+            linejunk = (lambda token: self.linejunk(items[token]))
+        else:
+            linejunk = None
+
+        codes = self._get_opcodes(tokens1, tokens2, linejunk)
 
         # コンテキスト差分オプションがNoneでない場合は
         if self.context != None:
-            # get_grouped_opcodesを使う
-            opcodes = cruncher.get_grouped_opcodes(self.context)
+            # get_grouped_opcodesと同様にグループ化する
+            opcodes = _group_opcodes(codes, self.context)
         else:
-            # get_opcodesを使う、ただしget_grouped_opcodesとインタフェースを
-            # 合わせるために呼び出した後1枚リストをかぶせる
-            opcodes = [cruncher.get_opcodes()]
+            # get_opcodesの結果を使う、ただしget_grouped_opcodesとインタフェースを
+            # 合わせるために1枚リストをかぶせる
+            opcodes = [codes]
+
+        # 並列処理する場合は、行内差分が必要な変更チェンジセットを
+        # 先にまとめてプロセスプールに投入しておく
+        pool = None
+        futures = {}
+        if self.workers is not None and self.workers > 1:
+            opcodes = list(opcodes)
+            blocks = [(seq1_low, seq1_high, seq2_low, seq2_high)
+                      for opcode in opcodes
+                      for (tag, seq1_low, seq1_high, seq2_low, seq2_high) in opcode
+                      if tag == 'replace' and
+                      _is_iterable_block(seq1, seq1_low, seq1_high, seq2, seq2_low, seq2_high)]
+            # 一致ブロックの検出で上限を超えた場合は、行内差分を並列に求めない
+            if len(blocks) > 1 and not self._over_budget():
+                import concurrent.futures
+                pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers)
+                futures = self._submit_fancy_replace(pool, seq1, seq2, blocks)
+
+        # 最後まで取り出した場合はプロセスの終了を待つ
+        # （途中で閉じられた場合だけ、残りを取り消して待たずに戻る）
+        closed = False
+        try:
+            for diff in self._compare_groups(seq1, seq2, opcodes, futures):
+                yield diff
+        except GeneratorExit:
+            closed = True
+            raise
+        finally:
+            if pool is not None:
+                for future in futures.values():
+                    future.cancel()
+                pool.shutdown(wait=not closed)
+        return
+
+    def compare_iter(self, iterable1, iterable2, window=4096):
+        r"""
+        Compare two iterables of items within a bounded window; return a generator
+        of the same representations as compare.
+
+        At most window items of each input are held at a time. Each window is
+        compared, the records up to its last run of common items are output,
+        and the rest is compared again together with the following items.
+        So the inputs can be generators (e.g. lines of huge files), but the
+        differences may be less minimal than compare's where items are moved
+        farther than the window. (equal_ranges and workers are not used.)
+
+        Example:
+
+        >>> seq1 = ['%d\n' % i for i in range(30)]
+        >>> seq2 = list(seq1)
+        >>> seq2[3], seq2[20] = 'x\n', 'y\n'
+        >>> differ = Differ(context=1)
+        >>> (list(differ.compare_iter(iter(seq1), iter(seq2), window=8)) ==
+        ...  list(differ.compare(seq1, seq2)))
+        True
+        """
+
+        self._reset_budget()
+
+        if self.linejunk is not None:
+            linejunk = (lambda token: self.linejunk(items[token]))
+        else:
+            linejunk = None
+
+        iter1 = iter(iterable1)
+        iter2 = iter(iterable2)
+        buffer1 = []
+        buffer2 = []
+        offset1 = 0
+        offset2 = 0
+        exhausted1 = exhausted2 = False
+        stream = _ContextStream(self.context)
+
+        while True:
+            # 窓の大きさまで先読みする
+            if not exhausted1:
+                buffer1.extend(itertools.islice(iter1, window - len(buffer1)))
+                exhausted1 = len(buffer1) < window
+            if not exhausted2:
+                buffer2.extend(itertools.islice(iter2, window - len(buffer2)))
+                exhausted2 = len(buffer2) < window
+            if not buffer1 and not buffer2: break
+
+            tokens1, tokens2, items = _intern(buffer1, buffer2)
+            codes = self._get_opcodes(tokens1, tokens2, linejunk)
+
+            # 入力が残っている場合は、最後の一致ブロックまでを確定させる
+            # （一致ブロックがなければ窓の全体を確定させる）
+            if not (exhausted1 and exhausted2):
+                last = len(codes) - 1
+                while last >= 0 and codes[last][0] != 'equal': last -= 1
+                if last >= 0: codes = codes[:last + 1]
+            seq1_cut = codes[-1][2]
+            seq2_cut = codes[-1][4]
+
+            for (tag, seq1_low, seq1_high, seq2_low, seq2_high) in codes:
+                if tag == 'equal':
+                    for num1, num2 in zip(range(seq1_low, seq1_high),
+                                          range(seq2_low, seq2_high)):
+                        for diff in stream.equal(((' ', num1 + offset1, buffer1[num1],
+                                                   num2 + offset2, buffer2[num2]), None)):
+                            yield diff
+                    continue
+
+                for diff in stream.change():
+                    yield diff
+                yield True
+                degraded = len(self.degraded)
+                for ((code, num1, item1, num2, item2), linediff) in self._compare_opcode(
+                        buffer1, buffer2, tag, seq1_low, seq1_high, seq2_low, seq2_high):
+                    if num1 is not None: num1 += offset1
+                    if num2 is not None: num2 += offset2
+                    yield ((code, num1, item1, num2, item2), linediff)
+                self.degraded[degraded:] = [
+                    (low1 + offset1, high1 + offset1, low2 + offset2, high2 + offset2)
+                    for (low1, high1, low2, high2) in self.degraded[degraded:]]
+                yield False
+
+            # 確定した分を窓から取り除く
+            del buffer1[:seq1_cut]
+            del buffer2[:seq2_cut]
+            offset1 += seq1_cut
+            offset2 += seq2_cut
+
+        for diff in stream.finish():
+            yield diff
+        return
 
+    # グループ化されたopcodesから差分を生成する
+    def _compare_groups(self, seq1, seq2, opcodes, futures=None):
         max_seq1_high = 0
         max_seq2_high = 0
         # 差分の纏まりのグループごとにループする
@@ -525,68 +2035,162 @@ class Differ:
                 if i == 0 and h == 0 and (seq1_low > 0 or seq2_low > 0):
                     yield None
                 yield True
-                # タグが変更の場合は
-                if   tag == 'replace':
-                    try:
-                        for num1, num2 in itertools.zip_longest(
-                            range(seq1_low, seq1_high),
-                            range(seq2_low, seq2_high)):
-                            if num1 is not None: iter(seq1[num1])
-                            if num2 is not None: iter(seq2[num2])
-                    except TypeError:
-                        for num1, num2 in itertools.zip_longest(
-                            range(seq1_low, seq1_high),
-                            range(seq2_low, seq2_high)):
-                            code = '|'
-                            if   num1 is None:
-                                code = '>'
-                            elif num2 is None:
-                                code = '<'
-                            yield ((code,
-                                    num1, seq1[num1] if num1 is not None else None,
-                                    num2, seq2[num2] if num2 is not None else None), None)
-                    else:
-                        # さらにその変更の纏まり（複数item）のなかから、
-                        # もっともマッチしたitemを検知し、その前後で
-                        # 再びもっともマッチしたitemを検知し、その前後で・・・
-                        # という再帰処理を行い、もっとも見た目が良い前後比較を作成する
-                        gen = self._fancy_replace(seq1, seq1_low, seq1_high,
-                                                  seq2, seq2_low, seq2_high)
-                        # ジェネレータを受け取るので要素を生成してyieldする
-                        for line in gen:
-                            yield line
-                # タグが削除の場合は
-                elif tag == 'delete':
-                    # 削除分のitemを個別に生成して返す
-                    # 削除のタグは'<'とし、必要のない情報についてはNoneで返す
-                    for num1 in range(seq1_low, seq1_high):
-                        yield (('<', num1, seq1[num1], None, None), None)
-                # タグが追加の場合は
-                elif tag == 'insert':
-                    # 追加分のitemを個別に生成して返す
-                    # 追加のタグは'>'とし、必要のない情報についてはNoneで返す
-                    for num2 in range(seq2_low, seq2_high):
-                        yield (('>', None, None, num2, seq2[num2]), None)
-                # タグが一致の場合は
-                elif tag == 'equal':
-                    # 互いのitem数が一致することをassertで確認する
-                    assert seq1_high - seq1_low == seq2_high - seq2_low
-                    # 一致分のitemを個別に生成して返す
-                    # 一致のタグは' 'とし、必要のない情報についてはNoneで返す
-                    for num1, num2 in zip(range(seq1_low, seq1_high),
-                                          range(seq2_low, seq2_high)):
-                        yield ((' ', num1, seq1[num1], num2, seq2[num2]), None)
-                # その他のタグを受け取った場合は
-                else:
-                    # 予定外なので例外を飛ばす
-                    raise ValueError('unknown tag \'' + tag + '\'')
-
+                for diff in self._compare_opcode(seq1, seq2, tag,
+                                                 seq1_low, seq1_high,
+                                                 seq2_low, seq2_high, futures):
+                    yield diff
                 yield False
             # コンテキストの終わりをあらわすNoneを返す
             if self.context != None and (max_seq1_high < len(seq1) or max_seq2_high < len(seq2)):
                 yield None
         return
 
+    # 1つのopcodeが表す範囲の差分を生成する
+    def _compare_opcode(self, seq1, seq2, tag,
+                        seq1_low, seq1_high, seq2_low, seq2_high, futures=None):
+        # タグが変更の場合は
+        if   tag == 'replace':
+            block = (seq1_low, seq1_high, seq2_low, seq2_high)
+            if not _is_iterable_block(seq1, seq1_low, seq1_high,
+                                      seq2, seq2_low, seq2_high):
+                for num1, num2 in itertools.zip_longest(
+                    range(seq1_low, seq1_high),
+                    range(seq2_low, seq2_high)):
+                    code = '|'
+                    if   num1 is None:
+                        code = '>'
+                    elif num2 is None:
+                        code = '<'
+                    yield ((code,
+                            num1, seq1[num1] if num1 is not None else None,
+                            num2, seq2[num2] if num2 is not None else None), None)
+            elif futures and block in futures:
+                # プロセスプールで処理した結果を受け取る
+                (records, degraded) = futures.pop(block).result()
+                self.degraded.extend(degraded)
+                for line in records:
+                    yield line
+            else:
+                # さらにその変更の纏まり（複数item）のなかから、
+                # もっともマッチしたitemを検知し、その前後で
+                # 再びもっともマッチしたitemを検知し、その前後で・・・
+                # という再帰処理を行い、もっとも見た目が良い前後比較を作成する
+                gen = self._fancy_replace(seq1, seq1_low, seq1_high,
+                                          seq2, seq2_low, seq2_high)
+                # ジェネレータを受け取るので要素を生成してyieldする
+                for line in gen:
+                    yield line
+        # タグが削除の場合は
+        elif tag == 'delete':
+            # 削除分のitemを個別に生成して返す
+            # 削除のタグは'<'とし、必要のない情報についてはNoneで返す
+            for num1 in range(seq1_low, seq1_high):
+                yield (('<', num1, seq1[num1], None, None), None)
+        # タグが追加の場合は
+        elif tag == 'insert':
+            # 追加分のitemを個別に生成して返す
+            # 追加のタグは'>'とし、必要のない情報についてはNoneで返す
+            for num2 in range(seq2_low, seq2_high):
+                yield (('>', None, None, num2, seq2[num2]), None)
+        # タグが一致の場合は
+        elif tag == 'equal':
+            # 互いのitem数が一致することをassertで確認する
+            assert seq1_high - seq1_low == seq2_high - seq2_low
+            # まとめて返す場合は範囲だけを返す
+            if self.equal_ranges:
+                yield EqualRange(' ', seq1_low, seq1_high, seq2_low, seq2_high)
+                return
+            # 一致分のitemを個別に生成して返す
+            # 一致のタグは' 'とし、必要のない情報についてはNoneで返す
+            for num1, num2 in zip(range(seq1_low, seq1_high),
+                                  range(seq2_low, seq2_high)):
+                yield ((' ', num1, seq1[num1], num2, seq2[num2]), None)
+        # その他のタグを受け取った場合は
+        else:
+            # 予定外なので例外を飛ばす
+            raise ValueError('unknown tag \'' + tag + '\'')
+        return
+
+    # 変更チェンジセットをプロセスプールに投入する
+    # 必要な範囲のitemだけを渡し、結果の行番号は元に戻す
+    def _submit_fancy_replace(self, pool, seq1, seq2, blocks):
+        options = dict(charjunk=self.charjunk, cutoff=self.cutoff, fuzzy=self.fuzzy,
+                       cutoffchar=self.cutoffchar, candidates=self.candidates,
+                       max_cost=self.max_cost)
+        if self.deadline is not None:
+            options['deadline'] = self.deadline - (_clock() - self._started)
+        futures = {}
+        for (seq1_low, seq1_high, seq2_low, seq2_high) in blocks:
+            futures[(seq1_low, seq1_high, seq2_low, seq2_high)] = pool.submit(
+                _fancy_replace_worker, options,
+                seq1[seq1_low:seq1_high], seq1_low,
+                seq2[seq2_low:seq2_high], seq2_low)
+        return futures
+
+    # 一致ブロックの検出(get_opcodes)を行う
+    # 先頭と末尾の共通部分は取り除き、残った中央部分のみをエンジンに渡す
+    # （difflib.SequenceMatcherは列全体から最長一致を選ぶので、取り除くと結果が
+    #   変わってしまう。そのため、最初に同じ処理をする_LineMatcherのエンジンに限る）
+    def _get_opcodes(self, tokens1, tokens2, linejunk=None):
+        r"""Give back the opcodes of the engine for two token arrays.
+
+        The common head and tail are trimmed before matching only for the
+        engines that trim them first anyway (_engine_trims_affix), so the
+        result is always the same as the one of the engine itself.
+        If the budget is exceeded while matching, all but the common head and
+        tail is given back as one change.
+
+        Example:
+
+        >>> tokens1, tokens2, items = _intern(['baz', 'baz', 'bar', 'baz', ''],
+        ...                                   ['bar', 'foo', 'foo', 'baz', '', 'foo', 'x', ''])
+        >>> Differ()._get_opcodes(tokens1, tokens2)
+        [('delete', 0, 2, 0, 0), ('equal', 2, 3, 0, 1), ('insert', 3, 3, 1, 3), ('equal', 3, 5, 3, 5), ('insert', 5, 5, 5, 8)]
+        >>> Differ(max_cost=0)._get_opcodes(tokens1, tokens2)
+        [('replace', 0, 4, 0, 7), ('equal', 4, 5, 7, 8)]
+        """
+        len1 = len(tokens1)
+        len2 = len(tokens2)
+        # 完全に一致する場合はエンジンを使わない
+        if tokens1 == tokens2:
+            return [('equal', 0, len1, 0, len2)] if len1 else []
+
+        # 指定されたエンジン(SequenceMatcher互換)のインスタンスを生成する
+        if _engine_trims_affix(self.engine):
+            prefix, suffix = _common_affix(tokens1, 0, len1, tokens2, 0, len2)
+            cruncher = _engines[self.engine](linejunk,
+                                             tokens1[prefix:len1 - suffix],
+                                             tokens2[prefix:len2 - suffix])
+        else:
+            prefix = suffix = 0
+            cruncher = _engines[self.engine](linejunk, tokens1, tokens2)
+        if self.max_cost is not None or self.deadline is not None:
+            cruncher.budget = self._charge
+
+        try:
+            middle = cruncher.get_opcodes()
+        except _BudgetExceeded:
+            # 上限を超えた場合は、先頭と末尾の共通部分を除いた残りを1つの変更とする
+            # （その変更チェンジセットは_fancy_replaceで単純な置き換えになり、degradedに記録される）
+            prefix, suffix = _common_affix(tokens1, 0, len1, tokens2, 0, len2)
+            high1 = len1 - prefix - suffix
+            high2 = len2 - prefix - suffix
+            tag = 'replace' if high1 and high2 else 'delete' if high1 else 'insert'
+            middle = [(tag, 0, high1, 0, high2)]
+        if not prefix and not suffix:
+            return middle
+
+        codes = []
+        if prefix:
+            codes.append(('equal', 0, prefix, 0, prefix))
+        for tag, seq1_low, seq1_high, seq2_low, seq2_high in middle:
+            codes.append((tag,
+                          seq1_low + prefix, seq1_high + prefix,
+                          seq2_low + prefix, seq2_high + prefix))
+        if suffix:
+            codes.append(('equal', len1 - suffix, len1, len2 - suffix, len2))
+        return codes
+
     # 1ブロックの線をもう一つと入れ替えるとき、
     # *similar*線を求めてブロックを捜してください;
     # 最もあっている一組（あるとしても）が同期点として使われます、
@@ -594,7 +2198,7 @@ class Differ:
     # しばしばそれの価値があるが、たくさんの仕事。
     def _fancy_replace(self,
                        seq1, seq1_low, seq1_high,
-                       seq2, seq2_low, seq2_high):
+                       seq2, seq2_low, seq2_high, index=None):
         r"""
         When replacing one block of lines with another, search the blocks
         for *similar* lines; the best-matching pair (if any) is used as a
@@ -641,6 +2245,64 @@ class Differ:
            (' ', '\n', '\n')])]
         """
 
+        # 比較する相手を絞り込むインデックスはチェンジセット全体で1回だけ作る
+        if (index is None and self.candidates is not None and
+            seq1_high - seq1_low > self.candidates):
+            index = _CandidateIndex(seq1, seq1_low, seq1_high, self.candidates)
+
+        # 再帰呼び出しの代わりに作業スタックを使う
+        # スタックには未処理の範囲(4要素のtuple)と、出力待ちの同期点(2要素のtuple)を積む
+        # 同期点で区切った前半、同期点、後半の順に出力されるよう逆順に積む
+        stack = [(seq1_low, seq1_high, seq2_low, seq2_high)]
+        while stack:
+            work = stack.pop()
+            if len(work) == 2:
+                # 同期点をそのままyieldする
+                yield work
+                continue
+
+            (seq1_low, seq1_high, seq2_low, seq2_high) = work
+            # seq1もしくはseq2が存在しない場合は、
+            # 単純な削除もしくは追加として返す
+            if seq1_low >= seq1_high or seq2_low >= seq2_high:
+                for line in self._plain_replace(seq1, seq1_low, seq1_high,
+                                                seq2, seq2_low, seq2_high):
+                    yield line
+                continue
+
+            if not self._over_budget():
+                synch = self._fancy_synch(seq1, seq1_low, seq1_high,
+                                          seq2, seq2_low, seq2_high, index)
+            else:
+                synch = None
+            if synch is None and self._over_budget():
+                # コストの上限を超えたので、同期点を探さずに単純な置き換えとする
+                self.degraded.append((seq1_low, seq1_high, seq2_low, seq2_high))
+            if synch is None:
+                # 同期点が無いので、単純に完全に置き換えられた文字列の集まりとする
+                for line in self._plain_replace(seq1, seq1_low, seq1_high,
+                                                seq2, seq2_low, seq2_high):
+                    yield line
+                continue
+
+            best_i, best_j, record = synch
+            # pump out diffs from after the synch point
+            # 同期点（最適なペア）で区切った場合の後半
+            stack.append((best_i + 1, seq1_high, best_j + 1, seq2_high))
+            # 同期点
+            stack.append(record)
+            # pump out diffs from before the synch point
+            # 同期点（最適なペア）で区切った場合の前半
+            stack.append((seq1_low, best_i, seq2_low, best_j))
+        return
+
+    # 同期点を探す
+    # 同期点が見つかった場合は(best_i, best_j, 同期点のレコード)を、
+    # 見つからない場合はNoneを返す
+    def _fancy_synch(self,
+                     seq1, seq1_low, seq1_high,
+                     seq2, seq2_low, seq2_high, index=None):
+
         # don't synch up unless the lines have a similarity score of at
         # least cutoff; best_ratio tracks the best score seen so far
         # 文字列がcutoffに到達しない場合は左右に並べません
@@ -658,12 +2320,32 @@ class Differ:
         # （同一の文字列はジャンク文字列でなければならない、
         # 　特別そうしたい場合以外は、ジャンクで同期すべきではない）
 
+        # チェンジセットが大きい場合は、比較する相手をインデックスで絞り込む
+        # （インデックスはチェンジセットごとに1回だけ作り、分割後も使い回す）
+        # さらに、seq2の先頭からcandidates個以上を調べて類似したペアが見つかれば
+        # そこで打ち切る（同期点が端に偏ると分割の段数が増え、各段で全体を
+        # 調べると全体で2乗の時間がかかるため）
+        pruning = (self.candidates is not None and
+                   seq1_high - seq1_low > self.candidates)
+        if pruning and index is None:
+            index = _CandidateIndex(seq1, seq1_low, seq1_high, self.candidates)
+
         # seq2について繰り返し処理する
         for seq2_pos in range(seq2_low, seq2_high):
-            # 取得したseq2の1itemをSequenceMatcherにセットする
-            cruncher.set_seq2(seq2[seq2_pos])
+            if pruning and best_found and seq2_pos - seq2_low >= self.candidates:
+                break
+            if pruning:
+                seq1_positions = index.candidates(seq2_pos, seq2[seq2_pos],
+                                                  seq1_low, seq1_high)
+                if equal_seq1_pos is None:
+                    equal_pos = index.equal(seq2[seq2_pos], seq1_low, seq1_high)
+                    if equal_pos is not None:
+                        equal_seq1_pos = equal_pos
+                        equal_seq2_pos = seq2_pos
+            else:
+                seq1_positions = range(seq1_low, seq1_high)
             # seq1について繰り返し処理する
-            for seq1_pos in range(seq1_low, seq1_high):
+            for seq1_pos in seq1_positions:
                 # 取得したseq1の1itemとseq2の1itemが完全一致する場合は
                 if seq1[seq1_pos] == seq2[seq2_pos]:
                     # すでに完全一致ペアが見つかって居ない場合は
@@ -674,7 +2356,20 @@ class Differ:
                     # このペアでやるべきことは何も無いので次のループへ
                     continue
 
-                # 取得したseq1の1itemをSequenceMatcherにセットする
+                # すでにベストマッチが見つかっていれば
+                # fuzzyを設定する
+                if best_found: fuzzy = self.fuzzy
+                # それ以外の場合はfuzzyに0をセットする
+                else: fuzzy = 0
+
+                # コストの上限を超えた場合は探索を打ち切る
+                self.cost += 1
+                if self._over_budget():
+                    return None
+
+                # 取得したseq2の1itemとseq1の1itemをSequenceMatcherにセットする
+                # （seq2が前回と同じitemであれば、set_seq2は何もしない）
+                cruncher.set_seq2(seq2[seq2_pos])
                 cruncher.set_seq1(seq1[seq1_pos])
                 # computing similarity is expensive, so use the quick
                 # upper bounds first -- have seen this speed up messy
@@ -689,12 +2384,6 @@ class Differ:
                 # もしくはreal_quick_ratio()を最初に試す。
                 # 計算の高価な一部は、クランチャーによって貯蔵されます
 
-                # すでにベストマッチが見つかっていれば
-                # fuzzyを設定する
-                if best_found: fuzzy = self.fuzzy
-                # それ以外の場合はfuzzyに0をセットする
-                else: fuzzy = 0
-
                 # この文字列全体のマッチ率を返す3つのメソッドは、
                 # 異なる近似値に基づく異なる結果を返す。
                 # とはいえ、quick_ratio()と real_quick_ratio()は、
@@ -706,13 +2395,34 @@ class Differ:
                 # 0.75
                 # >>> s.real_quick_ratio()
                 # 1.0
-                if (cruncher.real_quick_ratio() > best_ratio + fuzzy
-                and cruncher.quick_ratio()      > best_ratio + fuzzy
-                and cruncher.ratio()            > best_ratio + fuzzy):
+                ratio = cruncher.real_quick_ratio()
+                exact = False
+                if ratio > best_ratio + fuzzy:
+                    # 上限の判定を通ったペアに限り、以前に計算した正確なマッチ率を
+                    # キャッシュから再利用する（上限で弾かれるペアはキャッシュしない）
+                    entry = None
+                    if self.cache is not None:
+                        entry = self.cache.get((seq1[seq1_pos], seq2[seq2_pos]))
+                    if entry is not None:
+                        ratio = entry[0]
+                        exact = True
+                    else:
+                        # quick_ratioとratioの手間は文字数に比例するので、その分も加算する
+                        self.cost += len(seq1[seq1_pos]) + len(seq2[seq2_pos])
+                        if self._over_budget():
+                            return None
+                        ratio = cruncher.quick_ratio()
+                        if ratio > best_ratio + fuzzy:
+                            ratio = cruncher.ratio()
+                            exact = True
+                            if self.cache is not None:
+                                self.cache.put((seq1[seq1_pos], seq2[seq2_pos]),
+                                               [ratio, None])
+                if exact and ratio > best_ratio + fuzzy:
                     # 新たなベストマッチ（既存のベストマッチを
                     # 超えるマッチ率のペア）を見つけた
                     best_found = True
-                    best_ratio = cruncher.ratio()
+                    best_ratio = ratio
                     best_i = seq1_pos
                     best_j = seq2_pos
 
@@ -727,33 +2437,7 @@ class Differ:
             if equal_seq1_pos is None:
                 # no identical pair either -- treat it as a straight replace
                 # 単純に完全に置き換えられた文字列の集まりとする
-                # '|'が存在せず、'>'および'<'、もしくは'>'および'<'
-                # の集まりとする。
-                # どちらが採用されるかはそれぞれのitem数によって決まる
-                # itemが少ないほうが先に返される。
-
-                # dump the shorter block first -- reduces the burden on short-term
-                # memory if the blocks are of very different sizes
-                # 最初により少ないitem数を処理する
-                # これはitem数非常に異なるサイズの場合に、メモリ上の負荷を減らす効果がある
-
-                # seq2のほうがseq1よりitem数が少ない場合は
-                if seq2_high - seq2_low < seq1_high - seq1_low:
-                    # seq2について全itemを'>'としてyieldする
-                    for num2 in range(seq2_low, seq2_high):
-                        yield (('>', None, None, num2, seq2[num2]), None)
-                    # seq1について全itemを'<'としてyieldする
-                    for num1 in range(seq1_low, seq1_high):
-                        yield (('<', num1, seq1[num1], None, None), None)
-                # seq1のほうがseq2よりitem数が少ない場合は
-                else:
-                    # seq1について全itemを'<'としてyieldする
-                    for num1 in range(seq1_low, seq1_high):
-                        yield (('<', num1, seq1[num1], None, None), None)
-                    # seq2について全itemを'>'としてyieldする
-                    for num2 in range(seq2_low, seq2_high):
-                        yield (('>', None, None, num2, seq2[num2]), None)
-                return
+                return None
             # no close pair, but an identical pair -- synch up on that
             # 『同一でない「かなり近い」ペア』は無いが、
             # 同一のペアがあるので、それで同期を取る
@@ -775,13 +2459,6 @@ class Differ:
         # 同一のペアである場合は、equal_seq1_posはNoneではない
         # 非常に似ているペアの場合は、equal_seq1_posはNoneとなっている
 
-        # pump out diffs from before the synch point
-        # 同期点（最適なペア）で区切った場合の前半に対して
-        # 再帰的に同じ処理を行う（前半がなくなるまで続く）
-        for line in self._fancy_helper(seq1, seq1_low, best_i,
-                                       seq2, seq2_low, best_j):
-            yield line
-
         # do intraline marking on the synch pair
         # 最適なペアについてitem内差分を取得する
         seq1_elt = seq1[best_i]
@@ -796,129 +2473,171 @@ class Differ:
             #   * '+' : 追加
             #   * ' ' : 同一
             line_tags = ''
-            # SequenceMatcherを使用して差分を取得する
-            cruncher.set_seqs(seq1_elt, seq2_elt)
-
-            linediff_list = []
-            # 差分をグループごとに取得
-            for (tag,
-                 seq1_i1, seq1_i2,
-                 seq2_j1, seq2_j2) in cruncher.get_opcodes():
-
-                # グループ内のそれぞれの文字数を記憶する
-                la = seq1_i2 - seq1_i1
-                lb = seq2_j2 - seq2_j1
-
-                seq1_elta = seq1_elt[seq1_i1:seq1_i2]
-                seq2_elta = seq2_elt[seq2_j1:seq2_j2]
-
-                # 変更の場合
-                if   tag == 'replace':
-                    # 変更した文字をすべて同期して'!'で返すか、
-                    # 個別に'-'および'+'で返すかを判定する
-                    # （ratio()は0であることが確定しているので計算しない）
-                    # （メモリの負荷はそれほど考慮しなくてよいので'+'および'-'では
-                    # 　表示しない）
-                    if self.cutoffchar:
-                        # 個別に'-'および'+'で表示する
-                        linediff_list.append(('-', seq1_elta, None))
-                        linediff_list.append(('+', None, seq2_elta))
-                    else:
-                        # すべて同期して'!'で表示する
-                        linediff_list.append(('!', seq1_elta, seq2_elta))
-                # 削除の場合
-                elif tag == 'delete': linediff_list.append(('-', seq1_elta, None))
-                # 追加の場合
-                elif tag == 'insert': linediff_list.append(('+', None, seq2_elta))
-                # 同一の場合
-                elif tag == 'equal': linediff_list.append((' ', seq1_elta, seq2_elta))
-                # その他のタグを受け取った場合は
-                else:
-                    # 予定外なので例外を飛ばす
-                    raise ValueError('unknown tag \'' + tag + '\'')
-            yield (('|', best_i, seq1_elt, best_j, seq2_elt), linediff_list)
+            # キャッシュ済みの行内差分があれば再利用する
+            entry = None
+            if self.cache is not None:
+                entry = self.cache.get((seq1_elt, seq2_elt))
+                if entry is None:
+                    entry = [best_ratio, None]
+                    self.cache.put((seq1_elt, seq2_elt), entry)
+            if entry is not None and entry[1] is not None:
+                linediff_list = list(entry[1])
+            else:
+                # 行内差分の手間も文字数の分を加算する（超えた場合は同期点なしとする）
+                self.cost += len(seq1_elt) + len(seq2_elt)
+                if self._over_budget():
+                    return None
+                linediff_list = self._linediff(cruncher, seq1_elt, seq2_elt)
+                if entry is not None:
+                    entry[1] = tuple(linediff_list)
+            record = (('|', best_i, seq1_elt, best_j, seq2_elt), linediff_list)
         else:
             # the synch pair is identical
             # ペアは同一
-            yield ((' ', best_i, seq1_elt, best_j, seq2_elt), None)
-
-        # pump out diffs from after the synch point
-        # 同期点（最適なペア）で区切った場合の後半に対して
-        # 再帰的に同じ処理を行う（後半がなくなるまで続く）
-        for line in self._fancy_helper(seq1, best_i+1, seq1_high,
-                                       seq2, best_j+1, seq2_high):
-            yield line
-
-        return
-
-    # _fancy_replace()内から分割点の前半と後半の2回再帰的に
-    # 呼び出される際に使用される関数
-    def _fancy_helper(self,
-                      seq1, seq1_low, seq1_high,
-                      seq2, seq2_low, seq2_high):
-        g = []
-        # seq1が存在する
-        if seq1_low < seq1_high:
-            # seq2が存在する
-            if seq2_low < seq2_high:
-                # seq1とseq2が両方存在するので
-                # _fancy_replace()を再帰的に呼び出す
-                g = self._fancy_replace(seq1, seq1_low, seq1_high,
-                                        seq2, seq2_low, seq2_high)
-                # イテレータが返るのでそのままyieldする
-                for line in g:
-                    yield line
+            record = ((' ', best_i, seq1_elt, best_j, seq2_elt), None)
+
+        return best_i, best_j, record
+
+    # 同期するペアのitem内差分を取得する
+    def _linediff(self, cruncher, seq1_elt, seq2_elt):
+        # SequenceMatcherを使用して差分を取得する
+        cruncher.set_seqs(seq1_elt, seq2_elt)
+
+        linediff_list = []
+        # 差分をグループごとに取得
+        for (tag,
+             seq1_i1, seq1_i2,
+             seq2_j1, seq2_j2) in cruncher.get_opcodes():
+
+            # グループ内のそれぞれの文字数を記憶する
+            la = seq1_i2 - seq1_i1
+            lb = seq2_j2 - seq2_j1
+
+            seq1_elta = seq1_elt[seq1_i1:seq1_i2]
+            seq2_elta = seq2_elt[seq2_j1:seq2_j2]
+
+            # 変更の場合
+            if   tag == 'replace':
+                # 変更した文字をすべて同期して'!'で返すか、
+                # 個別に'-'および'+'で返すかを判定する
+                # （ratio()は0であることが確定しているので計算しない）
+                # （メモリの負荷はそれほど考慮しなくてよいので'+'および'-'では
+                # 　表示しない）
+                if self.cutoffchar:
+                    # 個別に'-'および'+'で表示する
+                    linediff_list.append(('-', seq1_elta, None))
+                    linediff_list.append(('+', None, seq2_elta))
+                else:
+                    # すべて同期して'!'で表示する
+                    linediff_list.append(('!', seq1_elta, seq2_elta))
+            # 削除の場合
+            elif tag == 'delete': linediff_list.append(('-', seq1_elta, None))
+            # 追加の場合
+            elif tag == 'insert': linediff_list.append(('+', None, seq2_elta))
+            # 同一の場合
+            elif tag == 'equal': linediff_list.append((' ', seq1_elta, seq2_elta))
+            # その他のタグを受け取った場合は
             else:
-                # seq1が存在してseq2が無いので、
-                # seq1について'<'で返す
-                for num1 in range(seq1_low, seq1_high):
-                    yield (('<', num1, seq1[num1], None, None), None)
-        # seq2が存在する
-        elif seq2_low < seq2_high:
-            # seq2が存在してseq1が無いので、
-            # seq2について'>'で返す
+                # 予定外なので例外を飛ばす
+                raise ValueError('unknown tag \'' + tag + '\'')
+        return linediff_list
+
+    # 置き換えられたitemの集まりを'<'および'>'として返す
+    def _plain_replace(self,
+                       seq1, seq1_low, seq1_high,
+                       seq2, seq2_low, seq2_high):
+        # dump the shorter block first -- reduces the burden on short-term
+        # memory if the blocks are of very different sizes
+        # 最初により少ないitem数を処理する
+        # これはitem数非常に異なるサイズの場合に、メモリ上の負荷を減らす効果がある
+
+        # seq2のほうがseq1よりitem数が少ない場合は
+        if seq2_high - seq2_low < seq1_high - seq1_low:
+            # seq2について全itemを'>'としてyieldする
+            for num2 in range(seq2_low, seq2_high):
+                yield (('>', None, None, num2, seq2[num2]), None)
+            # seq1について全itemを'<'としてyieldする
+            for num1 in range(seq1_low, seq1_high):
+                yield (('<', num1, seq1[num1], None, None), None)
+        # seq1のほうがseq2よりitem数が少ない場合は
+        else:
+            # seq1について全itemを'<'としてyieldする
+            for num1 in range(seq1_low, seq1_high):
+                yield (('<', num1, seq1[num1], None, None), None)
+            # seq2について全itemを'>'としてyieldする
             for num2 in range(seq2_low, seq2_high):
                 yield (('>', None, None, num2, seq2[num2]), None)
         return
 
     @staticmethod
-    def _colordiff(text_array, linediff, side, withbg=False): # side is 0(left) or 1(right)
+    def _colordiff(text_array, linediff, side, withbg=False, theme=None): # side is 0(left) or 1(right)
+        r"""
+        Color the wrapped rows of one side of a line along its inline diff.
+
+        The inline diff is walked once with a cursor (segment, offset in it).
+
+        Example:
+
+        >>> Differ._colordiff(['ab', 'cd'], [(' ', 'a', 'a'), ('!', 'bc', 'x'), (' ', 'd', 'd')], 0)
+        ['a\x1b[31;1mb\x1b[0m', '\x1b[31;1mc\x1b[0md']
+        """
+        codes = (theme or _default_theme).codes
         colortext_array = []
         index = 0
-        index_linediff = 0
+        offset = 0
         for text in text_array:
-            colortext = ''
-            while len(text) > 0:
-                if linediff[index][side + 1] is None:
+            pieces = []
+            remaining = len(text)
+            while remaining > 0:
+                (chartag, text1, text2) = linediff[index]
+                delta = text2 if side else text1
+                if delta is None:
                     index += 1
-                    index_linediff = 0
+                    offset = 0
                     continue
-                chartag = linediff[index][0]
-                linediff_delta = linediff[index][side + 1][index_linediff:]
-                minlen = min((len(text), len(linediff_delta)))
-                text = text[minlen:]
-                deltatext = linediff_delta[:minlen].replace('\t', ' ')
-
-                scolor  = _getcolor(True, chartag, side, 0, withbg=withbg)
-                ecolor  = _getcolor(True, chartag, side, 1, withbg=withbg)
-
-                colortext += scolor
-                colortext += deltatext
-                colortext += ecolor
-
-                if len(linediff_delta) == minlen:
+                size = min(remaining, len(delta) - offset)
+                (scolor, ecolor) = codes[(chartag, side, withbg, False)]
+                pieces.append(scolor)
+                pieces.append(delta[offset:offset + size].replace('\t', ' '))
+                pieces.append(ecolor)
+                remaining -= size
+                offset += size
+                if offset == len(delta):
                     index += 1
-                    index_linediff = 0
-                else:
-                    index_linediff += minlen
-            colortext_array.append(colortext)
+                    offset = 0
+            colortext_array.append(''.join(pieces))
         return colortext_array
 
-    def pretty_compare(self, lines1, lines2, width=130, withcolor=False, withbg=False, offset1=0, offset2=0):
+    def pretty_compare(self, lines1, lines2, width=130, withcolor=False, withbg=False, offset1=0, offset2=0,
+                       truncate=None, window=None):
         r"""
         Compare two sequences of string; return a generator of pretty difference representations.
+
+        If truncate is given, each line is rendered only within the window of
+        that width around its first change (elided parts are marked with '...').
+        If window is given, lines1 and lines2 can be iterators and are compared
+        by compare_iter within that window.
+
+        Example:
+
+        >>> differ = SideBySideDiffer()
+        >>> for line in differ.pretty_compare(
+        ...         ['a' * 50 + 'b' + 'c' * 50], ['a' * 50 + 'x' + 'c' * 50], 80, truncate=20):
+        ...     print('\'' + line + '\'')
+        '     1|...aaaaabcccccccc...            |      1|...aaaaaxcccccccc...'
+        ''
+        '[     ]      |        !           '
+        '[ <-  ]     1|...aaaaabcccccccc...'
+        '[  -> ]     1|...aaaaaxcccccccc...'
+        ''
         """
-        for diff in self.compare(lines1, lines2):
+        if window is not None:
+            diffs = self.compare_iter(lines1, lines2, window)
+        else:
+            diffs = self.compare(lines1, lines2)
+            if self.equal_ranges:
+                diffs = expand_equal_ranges(diffs, lines1, lines2)
+        for diff in diffs:
             if   diff is None:
                 for textlinediff in self.textlinediffs():
                     yield textlinediff
@@ -932,6 +2651,9 @@ class Differ:
                 ((tag, num1, text1, num2, text2), linediff) = diff
                 if num1 is not None: num1 += offset1
                 if num2 is not None: num2 += offset2
+                if truncate is not None:
+                    (text1, text2, linediff) = _truncate_record(
+                        text1, text2, linediff, truncate)
                 self.formattext(tag, num1, text1, num2, text2, width,
                     withcolor=withcolor, withbg=withbg, linediff=linediff)
                 if tag == '|':
@@ -957,11 +2679,58 @@ class Differ:
     def textdiffs(self):
         raise NotImplementedError()
 
+# 出力を保留している行のブロックを保持するバッファ
+# 保持している行数が上限を超えると、一時ファイルに書き出してメモリを空ける
+class _SpillBuffer:
+    r"""Buffer of blocks of lines, spilled to a temporary file beyond max_lines.
+
+    Example:
+
+    >>> buffer = _SpillBuffer(max_lines=2)
+    >>> buffer.append(['a', 'b'])
+    >>> buffer.append(['c'])
+    >>> buffer.blocks, buffer.spilled
+    ([], 1)
+    >>> buffer.append(['d'])
+    >>> list(buffer)
+    [['a', 'b'], ['c'], ['d']]
+    """
+
+    def __init__(self, max_lines=None):
+        self.max_lines = max_lines
+        self.blocks = []
+        self.lines = 0
+        self.spill = None
+        self.spilled = 0
+
+    def append(self, block):
+        self.blocks.append(block)
+        self.lines += len(block)
+        if self.max_lines is not None and self.lines > self.max_lines:
+            if self.spill is None: self.spill = tempfile.TemporaryFile()
+            pickle.dump(self.blocks, self.spill, pickle.HIGHEST_PROTOCOL)
+            self.spilled += 1
+            self.blocks = []
+            self.lines = 0
+
+    def __iter__(self):
+        if self.spill is not None:
+            self.spill.seek(0)
+            for i in range(self.spilled):
+                for block in pickle.load(self.spill):
+                    yield block
+            self.spill.close()
+        for block in self.blocks:
+            yield block
+
 class SideBySideDiffer(Differ):
+    # max_bufferは出力を保留する行数の上限で、超えた分は一時ファイルに書き出す
+    # （Noneの場合はすべてメモリに保持する）
     def __init__(self, *args, **kwargs):
+        self.max_buffer = kwargs.pop('max_buffer', None)
         Differ.__init__(self, *args, **kwargs)
         self.array_textdiffs = []
-        self.array_textlinediffs = []
+        self.array_textlinediffs = _SpillBuffer(self.max_buffer)
         return
 
     # 差分についてプレーンテキストでフォーマッティングを行う関数
@@ -1024,18 +2793,16 @@ class SideBySideDiffer(Differ):
         text2_array = _strwidthdiv(text2, textwidth)
 
         if tag == '|' and withcolor and linediff is not None:
-            colortext1_array = Differ._colordiff(text1_array, linediff, 0, withbg=withbg)
-            colortext2_array = Differ._colordiff(text2_array, linediff, 1, withbg=withbg)
+            colortext1_array = Differ._colordiff(text1_array, linediff, 0, withbg=withbg, theme=self.theme)
+            colortext2_array = Differ._colordiff(text2_array, linediff, 1, withbg=withbg, theme=self.theme)
 
         elif (tag == '<' or tag == '>') and withcolor:
-            scolor  = _getcolor(True, tag, 0, 0, withbg=withbg)
-            ecolor  = _getcolor(True, tag, 0, 1, withbg=withbg)
+            (scolor, ecolor) = self.theme.pair(tag, 0, withbg)
             colortext1_array = []
             for i, text1 in enumerate(text1_array):
                 colortext1_array.append(scolor + text1 + ecolor)
 
-            scolor  = _getcolor(True, tag, 1, 0, withbg=withbg)
-            ecolor  = _getcolor(True, tag, 1, 1, withbg=withbg)
+            (scolor, ecolor) = self.theme.pair(tag, 1, withbg)
             colortext2_array = []
             for i, text2 in enumerate(text2_array):
                 colortext2_array.append(scolor + text2 + ecolor)
@@ -1205,12 +2972,12 @@ class SideBySideDiffer(Differ):
             for line in textlinediff:
                 yield line
             yield ''
-        self.array_textlinediffs = []
+        self.array_textlinediffs = _SpillBuffer(self.max_buffer)
 
 class LikeUnifiedDiffer(SideBySideDiffer):
     def __init__(self, *args, **kwargs):
         SideBySideDiffer.__init__(self, *args, **kwargs)
-        self.array_textdiffs_delay = []
+        self.array_textdiffs_delay = _SpillBuffer(self.max_buffer)
         return
 
     def formattext(self, tag, num1, text1, num2, text2, width,
@@ -1235,20 +3002,18 @@ class LikeUnifiedDiffer(SideBySideDiffer):
             text2_array = []
 
         if tag == '|' and withcolor and linediff is not None:
-            colortext1_array = Differ._colordiff(text1_array, linediff, 0, withbg=withbg)
-            colortext2_array = Differ._colordiff(text2_array, linediff, 1, withbg=withbg)
+            colortext1_array = Differ._colordiff(text1_array, linediff, 0, withbg=withbg, theme=self.theme)
+            colortext2_array = Differ._colordiff(text2_array, linediff, 1, withbg=withbg, theme=self.theme)
 
         elif tag == '<' and withcolor:
-            scolor  = _getcolor(True, tag, 0, 0, withbg=withbg)
-            ecolor  = _getcolor(True, tag, 0, 1, withbg=withbg)
+            (scolor, ecolor) = self.theme.pair(tag, 0, withbg)
             colortext1_array = []
             colortext2_array = []
             for i, text1 in enumerate(text1_array):
                 colortext1_array.append(scolor + text1 + ecolor)
 
         elif tag == '>' and withcolor:
-            scolor  = _getcolor(True, tag, 1, 0, withbg=withbg)
-            ecolor  = _getcolor(True, tag, 1, 1, withbg=withbg)
+            (scolor, ecolor) = self.theme.pair(tag, 1, withbg)
             colortext1_array = []
             colortext2_array = []
             for i, text2 in enumerate(text2_array):
@@ -1283,11 +3048,9 @@ class LikeUnifiedDiffer(SideBySideDiffer):
                         scolor = ''
                         ecolor = ''
                         if ptag == '-':
-                            scolor  = _getcolor(True, ptag, 0, 0, withbg=withbg)
-                            ecolor  = _getcolor(True, ptag, 0, 1, withbg=withbg)
+                            (scolor, ecolor) = self.theme.pair(ptag, 0, withbg)
                         elif ptag == '+':
-                            scolor  = _getcolor(True, ptag, 1, 0, withbg=withbg)
-                            ecolor  = _getcolor(True, ptag, 1, 1, withbg=withbg)
+                            (scolor, ecolor) = self.theme.pair(ptag, 1, withbg)
                         cptag = scolor + ptag + ecolor
                         cpnum1 = scolor + pnum1.rjust(6) + ecolor
                         cpnum2 = scolor + pnum2.rjust(6) + ecolor
@@ -1317,7 +3080,7 @@ class LikeUnifiedDiffer(SideBySideDiffer):
         for textdiff in self.array_textdiffs_delay:
             for line in textdiff:
                 yield line
-        self.array_textdiffs_delay = []
+        self.array_textdiffs_delay = _SpillBuffer(self.max_buffer)
 
 def tabulate(diffs, truncate=None):
     r"""
@@ -1347,6 +3110,10 @@ def tabulate(diffs, truncate=None):
         if diff is None:
             html += '<tr><td colspan="11" style="text-align: center; background: #E0F4FE;">...</td></tr>'
             continue
+        if isinstance(diff, EqualRange):
+            html += ('<tr><td colspan="11" style="text-align: center; background: #f5f7f8;">'
+                     '{}:{} = {}:{}</td></tr>'.format(diff.lo1, diff.hi1, diff.lo2, diff.hi2))
+            continue
         ((code, idx1, seq1, idx2, seq2), idiffs) = diff
         bgc = bgc1 = bgcn1 = bgc2 = bgcn2 = '#fff'
         syladd = syladd1 = syladd2 = ""
@@ -1430,6 +3197,294 @@ def tabulate(diffs, truncate=None):
     return JupyterHTMLStr(html)
 
 
+# 2つのファイルの内容が同一かを返す（大きさは比較済みとする）
+def _same_contents(path1, path2, bufsize=BUFSIZE):
+    with open(path1, 'rb') as fp1:
+        with open(path2, 'rb') as fp2:
+            while True:
+                buff1 = fp1.read(bufsize)
+                buff2 = fp2.read(bufsize)
+                if buff1 != buff2: return False
+                if not buff1: return True
+
+# ファイルの内容のダイジェストと、テキストファイルかどうか(_is_textと同じ判定)を一度に求める
+def _digest_file(path, bufsize=BUFSIZE):
+    digest = hashlib.sha256()
+    is_text = True
+    with open(path, 'rb') as fp:
+        while True:
+            buff = fp.read(bufsize)
+            if not buff: break
+            digest.update(buff)
+            if is_text and b'\0' in buff: is_text = False
+    return digest.digest(), is_text
+
+# ダイジェストのキャッシュの既定の場所
+def _default_digest_cache_path():
+    cache_home = (os.environ.get('XDG_CACHE_HOME') or
+                  os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(cache_home, 'uxdiff', 'digests.sqlite3')
+
+# ファイルの内容のダイジェストを、実行をまたいでSQLiteのファイルに保存するキャッシュ
+# （デバイス番号、iノード番号、大きさ、更新時刻が同じファイルは内容も同じとみなし、読まずに済ませる）
+class _DigestCache:
+    r"""On-disk cache of content digests keyed by (device, inode, size, mtime_ns).
+
+    Files modified within the last `recent` seconds are not stored, since
+    they may still be modified without their mtime changing.
+
+    Example:
+
+    >>> import tempfile, shutil
+    >>> top = tempfile.mkdtemp()
+    >>> path = os.path.join(top, 'file')
+    >>> with open(path, 'wb') as fp: _ = fp.write(b'abc')
+    >>> os.utime(path, (0, 0))
+    >>> cache = _DigestCache(os.path.join(top, 'cache', 'digests.sqlite3'))
+    >>> digest, is_text = cache.get(path, os.stat(path))
+    >>> cache.close()
+    >>> with open(path, 'wb') as fp: _ = fp.write(b'\0bc') # same size and mtime
+    >>> os.utime(path, (0, 0))
+    >>> cache = _DigestCache(os.path.join(top, 'cache', 'digests.sqlite3'))
+    >>> cache.get(path, os.stat(path)) == (digest, True)
+    True
+    >>> cache.close(); shutil.rmtree(top)
+    """
+
+    def __init__(self, path, bufsize=BUFSIZE*128, recent=2.0):
+        import sqlite3, threading
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.isdir(dirname): os.makedirs(dirname)
+        self.path = path
+        self.bufsize = bufsize
+        self.recent = recent
+        self._sqlite3 = sqlite3
+        # same_manyのスレッドからも使うので、接続はロックで守る
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS digests ('
+                         'dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER, '
+                         'digest BLOB, text INTEGER, '
+                         'PRIMARY KEY (dev, ino, size, mtime_ns))')
+        self._db.commit()
+        self._pending = []
+
+    @staticmethod
+    def _key(st):
+        # SQLiteの整数は符号付き64bitなので、大きなiノード番号などは負の数に直す
+        signed = lambda value: value - (1 << 64) if value >= (1 << 63) else value
+        mtime_ns = getattr(st, 'st_mtime_ns', None) # python3.3+
+        if mtime_ns is None: mtime_ns = int(st.st_mtime * 1000000000)
+        return (signed(st.st_dev), signed(st.st_ino), st.st_size, mtime_ns)
+
+    def get(self, path, st):
+        """Give back (digest, is_text) of the file, reading it only if not cached."""
+        # iノード番号がないファイルシステムではファイルを区別できないので、毎回読む
+        if not st.st_ino: return _digest_file(path, self.bufsize)
+        key = self._key(st)
+        with self._lock:
+            row = self._db.execute('SELECT digest, text FROM digests WHERE '
+                                   'dev = ? AND ino = ? AND size = ? AND mtime_ns = ?',
+                                   key).fetchone()
+        if row is not None:
+            return bytes(row[0]), bool(row[1])
+        digest, is_text = _digest_file(path, self.bufsize)
+        if st.st_mtime < time.time() - self.recent:
+            with self._lock:
+                self._pending.append(key + (self._sqlite3.Binary(digest), int(is_text)))
+        return digest, is_text
+
+    def close(self):
+        with self._lock:
+            if self._pending:
+                self._db.executemany('INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?, ?)',
+                                     self._pending)
+                self._db.commit()
+                self._pending = []
+            self._db.close()
+
+# ディレクトリの比較で、同じパスに何度もstatしないためのキャッシュ
+# （os.scandirで得られたファイルの種類を使い、statの結果、ファイルの比較結果、
+#   テキストかバイナリかの判定を、比較を実行している間だけ覚えておく）
+#   * workers
+#      same_manyでファイルの内容を比較するスレッド数。Noneの場合は並列化しない。
+#   * bufsize
+#      ファイルの内容を比較する際に一度に読む大きさ。
+#   * size_check
+#      Trueの場合、大きさが異なるファイルは内容を読まずに異なるとする。
+#   * digests
+#      _DigestCacheオブジェクト。指定された場合、ファイルの内容の比較と
+#      テキストかバイナリかの判定は、キャッシュされたダイジェストで行う。
+class _StatCache:
+    r"""Per-run cache of directory listings, stats and file comparisons.
+
+    Example:
+
+    >>> import tempfile, shutil
+    >>> top = tempfile.mkdtemp()
+    >>> os.mkdir(os.path.join(top, 'd'))
+    >>> for name, data in (('a', b'x'), ('b', b'y'), ('c', b'\0')):
+    ...     with open(os.path.join(top, name), 'wb') as fp: _ = fp.write(data)
+    >>> cache = _StatCache()
+    >>> sorted(cache.listdir(top))
+    ['a', 'b', 'c', 'd']
+    >>> [cache.kind(os.path.join(top, name)) for name in ('a', 'd', 'none')]
+    ['f', 'd', None]
+    >>> cache.same(os.path.join(top, 'a'), os.path.join(top, 'b'))
+    False
+    >>> cache.is_text(os.path.join(top, 'a')), cache.is_text(os.path.join(top, 'c'))
+    (True, False)
+    >>> cache = _StatCache(workers=2)
+    >>> cache.same_many([(os.path.join(top, x), os.path.join(top, y))
+    ...                  for (x, y) in (('a', 'a'), ('a', 'b'), ('a', 'none'))])
+    [True, False, None]
+    >>> cache.close(); shutil.rmtree(top)
+    """
+
+    def __init__(self, workers=None, bufsize=BUFSIZE*128, size_check=True, digests=None):
+        self.workers = workers
+        self.bufsize = bufsize
+        self.size_check = size_check
+        self.digests = digests
+        self._pool = None
+        import threading
+        self._pool_lock = threading.Lock()
+        self._entries = {}
+        self._kinds = {}
+        self._stats = {}
+        self._same = {}
+        self._texts = {}
+
+    def listdir(self, path):
+        """Give back the names in the directory, remembering their entries."""
+        scandir = getattr(os, 'scandir', None) # python3.5+
+        if scandir is None: return os.listdir(path)
+        names = []
+        iterator = scandir(path)
+        try:
+            for entry in iterator:
+                names.append(entry.name)
+                self._entries[entry.path] = entry
+        finally:
+            if hasattr(iterator, 'close'): iterator.close()
+        return names
+
+    def kind(self, path):
+        """Give back 'd' (directory), 'f' (regular file), '?' (other) or None (error)."""
+        try:
+            return self._kinds[path]
+        except KeyError:
+            pass
+        entry = self._entries.get(path)
+        try:
+            if entry is not None:
+                # シンボリックリンクでなければ、statせずにscandirで得た種類を使う
+                if   entry.is_dir():  kind = 'd'
+                elif entry.is_file(): kind = 'f'
+                else: kind = '?' if self.stat(path) is not None else None
+            else:
+                mode = self.stat(path)
+                if mode is None:                 kind = None
+                elif stat.S_ISDIR(mode.st_mode): kind = 'd'
+                elif stat.S_ISREG(mode.st_mode): kind = 'f'
+                else:                            kind = '?'
+        except OSError:
+            kind = None
+        self._kinds[path] = kind
+        return kind
+
+    def stat(self, path):
+        """Give back the stat of the path (following symlinks), or None on error."""
+        try:
+            return self._stats[path]
+        except KeyError:
+            pass
+        entry = self._entries.get(path)
+        try:
+            result = entry.stat() if entry is not None else os.stat(path)
+        except OSError:
+            result = None
+        self._stats[path] = result
+        return result
+
+    def same(self, path1, path2):
+        """Give back whether the contents are the same, or None on error (like filecmp.cmp)."""
+        key = (path1, path2)
+        try:
+            return self._same[key]
+        except KeyError:
+            pass
+        stat1 = self.stat(path1)
+        stat2 = self.stat(path2)
+        if stat1 is None or stat2 is None:
+            result = None
+        elif not (stat.S_ISREG(stat1.st_mode) and stat.S_ISREG(stat2.st_mode)):
+            result = False
+        elif self.size_check and stat1.st_size != stat2.st_size:
+            result = False
+        else:
+            try:
+                if self.digests is not None:
+                    result = self._digest(path1)[0] == self._digest(path2)[0]
+                else:
+                    result = _same_contents(path1, path2, self.bufsize)
+            except (IOError, OSError):
+                result = None
+        self._same[key] = result
+        return result
+
+    def same_many(self, pairs):
+        """Give back same() of each pair, comparing them in the worker threads."""
+        pairs = list(pairs)
+        pending = [pair for pair in pairs if pair not in self._same]
+        # 読み込みを待つ間はGILが解放されるので、スレッドで並列に読み込む
+        if self.workers is not None and self.workers > 1 and len(pending) > 1:
+            # _DirPrefetcherのスレッドからも呼ばれるので、プールは1つだけ作る
+            with self._pool_lock:
+                if self._pool is None:
+                    try:
+                        import concurrent.futures
+                    except ImportError: # python2.x
+                        self.workers = None
+                    else:
+                        self._pool = concurrent.futures.ThreadPoolExecutor(
+                            max_workers=self.workers)
+                pool = self._pool
+            if pool is not None:
+                for _ in pool.map(lambda pair: self.same(*pair), pending): pass
+        return [self.same(path1, path2) for (path1, path2) in pairs]
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+        if self.digests is not None:
+            self.digests.close()
+            self.digests = None
+
+    def is_text(self, path):
+        """Give back whether the file looks like a text file (see _is_text)."""
+        try:
+            return self._texts[path]
+        except KeyError:
+            pass
+        mode = self.stat(path)
+        if mode is not None and stat.S_ISREG(mode.st_mode) and mode.st_size == 0:
+            result = True
+        elif self.digests is not None and mode is not None and stat.S_ISREG(mode.st_mode):
+            result = self._digest(path)[1]
+        else:
+            result = _is_text(path)
+        self._texts[path] = result
+        return result
+
+    # ダイジェストのキャッシュから(digest, is_text)を得る
+    # （テキストかバイナリかの判定も同時に得られるので覚えておく）
+    def _digest(self, path):
+        digest, is_text = self.digests.get(path, self.stat(path))
+        self._texts[path] = is_text
+        return digest, is_text
+
 # filecmp.dircmp (DirDiffer)
 #  |-- left_list           [files or dirs]
 #  | |-- left_only         [files or dirs]
@@ -1452,17 +3507,34 @@ def tabulate(diffs, truncate=None):
 #          `-- (ext_common_funny)  [????]
 
 class DirDiffer(filecmp.dircmp):
+    r"""filecmp.dircmp extended with the ext_* lists, sharing one _StatCache.
+
+    Every phase asks stat_cache instead of os.stat, so that each path is
+    stat-ed at most once in a run (subdirectories share the same cache).
+    """
+
+    def __init__(self, a, b, ignore=None, hide=None, stat_cache=None):
+        filecmp.dircmp.__init__(self, a, b, ignore, hide)
+        self.stat_cache = stat_cache if stat_cache is not None else _StatCache()
+
+    def phase0(self): # Compare everything except common subdirectories
+        skip = self.hide + self.ignore
+        self.left_list  = sorted(x for x in self.stat_cache.listdir(self.left)
+                                 if x not in skip)
+        self.right_list = sorted(x for x in self.stat_cache.listdir(self.right)
+                                 if x not in skip)
 
     def phase1(self): # Compute common names
         filecmp.dircmp.phase1(self)
+        kind = self.stat_cache.kind
         self.ext_left_only_dirs   = [x for x in self.left_only
-                                     if os.path.isdir (os.path.join(self.left,  x))]
+                                     if kind(os.path.join(self.left,  x)) == 'd']
         self.ext_right_only_dirs  = [x for x in self.right_only
-                                     if os.path.isdir (os.path.join(self.right, x))]
+                                     if kind(os.path.join(self.right, x)) == 'd']
         self.ext_left_only_files  = [x for x in self.left_only
-                                     if os.path.isfile(os.path.join(self.left,  x))]
+                                     if kind(os.path.join(self.left,  x)) == 'f']
         self.ext_right_only_files = [x for x in self.right_only
-                                     if os.path.isfile(os.path.join(self.right, x))]
+                                     if kind(os.path.join(self.right, x)) == 'f']
 
 
     def phase2(self): # Distinguish files, directories, funnies
@@ -1473,34 +3545,23 @@ class DirDiffer(filecmp.dircmp):
         self.ext_files_to_dirs = []
         self.ext_common_funny = []
 
+        kind = self.stat_cache.kind
         for x in self.common:
-            a_path = os.path.join(self.left, x)
-            b_path = os.path.join(self.right, x)
+            a_kind = kind(os.path.join(self.left,  x))
+            b_kind = kind(os.path.join(self.right, x))
 
-            ok = 1
-            try:
-                a_stat = os.stat(a_path)
-            except os.error:
-                ok = 0
-            try:
-                b_stat = os.stat(b_path)
-            except os.error:
-                ok = 0
-
-            if ok:
-                a_type = stat.S_IFMT(a_stat.st_mode)
-                b_type = stat.S_IFMT(b_stat.st_mode)
-                if a_type != b_type:
+            if a_kind is not None and b_kind is not None:
+                if a_kind != b_kind:
                     self.common_funny.append(x)
-                    if   stat.S_ISDIR(a_type) and stat.S_ISREG(b_type):
+                    if   a_kind == 'd' and b_kind == 'f':
                         self.ext_dirs_to_files.append(x)
-                    elif stat.S_ISREG(a_type) and stat.S_ISDIR(b_type):
+                    elif a_kind == 'f' and b_kind == 'd':
                         self.ext_files_to_dirs.append(x)
                     else:
                         self.ext_common_funny.append(x)
-                elif stat.S_ISDIR(a_type):
+                elif a_kind == 'd':
                     self.common_dirs.append(x)
-                elif stat.S_ISREG(a_type):
+                elif a_kind == 'f':
                     self.common_files.append(x)
                 else:
                     self.common_funny.append(x)
@@ -1510,8 +3571,15 @@ class DirDiffer(filecmp.dircmp):
                 self.ext_common_funny.append(x)
 
     def phase3(self): # Find out differences between common files
-        xx = filecmp.cmpfiles(self.left, self.right, self.common_files, shallow=0)
-        self.same_files, self.diff_files, self.funny_files = xx
+        self.same_files = []
+        self.diff_files = []
+        self.funny_files = []
+        pairs = [(os.path.join(self.left, x), os.path.join(self.right, x))
+                 for x in self.common_files]
+        for x, same in zip(self.common_files, self.stat_cache.same_many(pairs)):
+            if same is None: self.funny_files.append(x)
+            elif same:       self.same_files.append(x)
+            else:            self.diff_files.append(x)
 
     def phase4(self): # Find out differences between common subdirectories
         # A new dircmp object is created for each common subdirectory,
@@ -1521,7 +3589,8 @@ class DirDiffer(filecmp.dircmp):
         for x in self.common_dirs:
             a_x = os.path.join(self.left, x)
             b_x = os.path.join(self.right, x)
-            self.subdirs[x]  = DirDiffer(a_x, b_x, self.ignore, self.hide)
+            self.subdirs[x]  = DirDiffer(a_x, b_x, self.ignore, self.hide,
+                                         stat_cache=self.stat_cache)
 
     def __getattr__(self, attr):
         methodmap = {'subdirs' : self.phase4,
@@ -1549,115 +3618,71 @@ class DirDiffer(filecmp.dircmp):
         return getattr(self, attr)
 
     def dirtree(self):
-        left_dirset = set(self.ext_left_only_dirs  +
-                          self.common_dirs         +
-                          self.ext_dirs_to_files)
-        left_fileset = set(self.ext_files_to_dirs    +
-                           self.ext_left_only_files  +
-                           self.same_files       +
-                           self.diff_files       +
-                           self.funny_files      +
-                           self.ext_common_funny)
-        right_dirset = set(self.ext_right_only_dirs +
-                           self.common_dirs         +
-                           self.ext_files_to_dirs)
-        right_fileset = set(self.ext_dirs_to_files    +
-                            self.ext_right_only_files +
-                            self.same_files       +
-                            self.diff_files       +
-                            self.funny_files      +
-                            self.ext_common_funny)
-
-        left_list  = ([('d', left_dir)   for left_dir   in sorted(left_dirset)] +
-                      [('f', left_file)  for left_file  in sorted(left_fileset)])
-        right_list = ([('d', right_dir)  for right_dir  in sorted(right_dirset)] +
-                      [('f', right_file) for right_file in sorted(right_fileset)])
-
-        if len(left_list):
-            last_left = left_list[-1]
-            left_islast = False
-        else:
-            left_islast = None
-        if len(right_list):
-            last_right = right_list[-1]
-            right_islast = False
-        else:
-            right_islast = None
-
-        ftype = 'd'
-        dirset = set(self.ext_left_only_dirs  +
-                     self.ext_right_only_dirs +
-                     self.common_dirs         +
-                     self.ext_dirs_to_files   +
-                     self.ext_files_to_dirs)
-        for dirname in sorted(dirset):
-            dircmpobj = None
-            if   (dirname in self.ext_left_only_dirs or
-                  dirname in self.ext_dirs_to_files):
-                tag = '<'
-            elif (dirname in self.ext_right_only_dirs or
-                  dirname in self.ext_files_to_dirs):
-                tag = '>'
-            elif dirname in self.common_dirs:
-                tag = ' '
-                dircmpobj = self.subdirs[dirname]
-            else:
-                tag = '?'
-
-            if (left_islast is not None and
-                last_left[0] == ftype and
-                last_left[1] == dirname): left_islast = True
-            if (right_islast is not None and
-                last_right[0] == ftype and
-                last_right[1] == dirname): right_islast = True
-
-            yield (ftype, tag, dirname, dircmpobj, left_islast, right_islast)
-
-            if left_islast:  left_islast = None
-            if right_islast: right_islast = None
-
-
-        ftype = 'f'
-        fileset = set(self.ext_dirs_to_files    +
-                      self.ext_files_to_dirs    +
-                      self.ext_left_only_files  +
-                      self.ext_right_only_files +
-                      self.same_files       +
-                      self.diff_files       +
-                      self.funny_files      +
-                      self.ext_common_funny)
-        for filename in sorted(fileset):
-            if   (filename in self.ext_files_to_dirs or
-                  filename in self.ext_left_only_files):
-                tag = '<'
-            elif (filename in self.ext_dirs_to_files or
-                  filename in self.ext_right_only_files):
-                tag = '>'
-            elif filename in self.same_files:
-                tag = ' '
-            elif filename in self.diff_files:
-                tag = '|'
-            else:
-                tag = '?'
+        r"""Give back a generator of (ftype, tag, name, dircmpobj, left_islast, right_islast).
 
-            if (left_islast is not None and
-                last_left[0] == ftype and
-                last_left[1] == filename): left_islast = True
-            if (right_islast is not None and
-                last_right[0] == ftype and
-                last_right[1] == filename): right_islast = True
-
-            yield (ftype, tag, filename, None, left_islast, right_islast)
-
-            if left_islast:  left_islast = None
-            if right_islast: right_islast = None
+        Directories come first, then files, each sorted by name. The tag of
+        each name is looked up in maps built once from the phase lists.
+        """
+        # 名前からタグへの対応表を作る（後に書いたものほど優先される）
+        dirtags = {}
+        for names, tag in ((self.common_dirs,         ' '),
+                           (self.ext_right_only_dirs, '>'),
+                           (self.ext_files_to_dirs,   '>'),
+                           (self.ext_left_only_dirs,  '<'),
+                           (self.ext_dirs_to_files,   '<')):
+            dirtags.update(dict.fromkeys(names, tag))
+        filetags = {}
+        for names, tag in ((self.funny_files,          '?'),
+                           (self.ext_common_funny,     '?'),
+                           (self.diff_files,           '|'),
+                           (self.same_files,           ' '),
+                           (self.ext_dirs_to_files,    '>'),
+                           (self.ext_right_only_files, '>'),
+                           (self.ext_files_to_dirs,    '<'),
+                           (self.ext_left_only_files,  '<')):
+            filetags.update(dict.fromkeys(names, tag))
+
+        # 左右それぞれの最後の項目（ファイルがあれば最後のファイル、なければ最後のディレクトリ）
+        def lastitem(dirlists, filelists):
+            files = [max(names) for names in filelists if names]
+            if files: return ('f', max(files))
+            dirs = [max(names) for names in dirlists if names]
+            if dirs: return ('d', max(dirs))
+            return None
+        last_left  = lastitem((self.ext_left_only_dirs, self.common_dirs,
+                               self.ext_dirs_to_files),
+                              (self.ext_files_to_dirs, self.ext_left_only_files,
+                               self.same_files, self.diff_files,
+                               self.funny_files, self.ext_common_funny))
+        last_right = lastitem((self.ext_right_only_dirs, self.common_dirs,
+                               self.ext_files_to_dirs),
+                              (self.ext_dirs_to_files, self.ext_right_only_files,
+                               self.same_files, self.diff_files,
+                               self.funny_files, self.ext_common_funny))
+        left_islast  = False if last_left  is not None else None
+        right_islast = False if last_right is not None else None
+
+        for ftype, tags in (('d', dirtags), ('f', filetags)):
+            for name in sorted(tags):
+                tag = tags[name]
+                dircmpobj = None
+                if ftype == 'd' and tag == ' ':
+                    dircmpobj = self.subdirs[name]
+
+                if left_islast is not None and last_left == (ftype, name): left_islast = True
+                if right_islast is not None and last_right == (ftype, name): right_islast = True
+
+                yield (ftype, tag, name, dircmpobj, left_islast, right_islast)
+
+                if left_islast:  left_islast = None
+                if right_islast: right_islast = None
 
         return
 
 
 def _formatdircmp(tag, head1, text1, head2, text2, width,
                  cont_mark1='^', cont_mark2='^', sep_mark='|',
-                 withcolor=False, withbg=False):
+                 withcolor=False, withbg=False, theme=None):
     pwidth = ((_strwidth(head1) + _strwidth(sep_mark)) +
               (1 + _strwidth(tag) + 1) +
               (_strwidth(head2) + _strwidth(sep_mark)))
@@ -1668,6 +3693,13 @@ def _formatdircmp(tag, head1, text1, head2, text2, width,
     text1_array = _strwidthdiv(text1, textwidth)
     text2_array = _strwidthdiv(text2, textwidth)
 
+    if withcolor:
+        theme = theme or _default_theme
+        (scolor1, ecolor1) = theme.pair(tag, 0, withbg, isdircmp=True)
+        (scolor2, ecolor2) = theme.pair(tag, 1, withbg, isdircmp=True)
+    else:
+        scolor1 = ecolor1 = scolor2 = ecolor2 = ''
+
     for i in range(max(len(text1_array), len(text2_array))):
         line = ''
         if i != 0: head1 = cont_mark1
@@ -1682,23 +3714,24 @@ def _formatdircmp(tag, head1, text1, head2, text2, width,
 
         line += head1
         line += sep_mark
-        line += _getcolor(withcolor, tag, 0, 0, isdircmp=True, withbg=withbg)
+        line += scolor1
         line += ptext1
-        line += _getcolor(withcolor, tag, 0, 1, isdircmp=True, withbg=withbg)
+        line += ecolor1
         line += (max(textwidth - _strwidth(ptext1), 0) * ' ' + '')
         if   i == 0:     line += (' ' + tag + ' ')
         elif tag == ' ': line += (' ' + ' ' + ' ')
         else:            line += (' ' + '^' + ' ')
         line += head2
         line += sep_mark
-        line += _getcolor(withcolor, tag, 1, 0, isdircmp=True, withbg=withbg)
+        line += scolor2
         line += ptext2
-        line += _getcolor(withcolor, tag, 1, 1, isdircmp=True, withbg=withbg)
+        line += ecolor2
         yield line
     return
 
 # 独自の形式で等幅フォントのターミナルで表示するための文字列の差分を返す。
-def _original_diff(differ, lines1, lines2, width, withcolor=False, withbg=False):
+def _original_diff(differ, lines1, lines2, width, withcolor=False, withbg=False, truncate=None,
+                   window=None):
     r"""
 
     Example:
@@ -1740,110 +3773,207 @@ def _original_diff(differ, lines1, lines2, width, withcolor=False, withbg=False)
     ''
     """
 
-    lines1 = [_expandtabs(line, tabsize=4) for line in lines1]
-    lines2 = [_expandtabs(line, tabsize=4) for line in lines2]
+    if isinstance(lines1, MappedLines) and isinstance(lines2, MappedLines):
+        # mmapしたファイルは、デコードした行ごとに展開する
+        lines1 = lines1.map(functools.partial(_expandtabs, tabsize=4))
+        lines2 = lines2.map(functools.partial(_expandtabs, tabsize=4))
+    elif window is None:
+        lines1 = _expandtabs_lines(lines1, tabsize=4)
+        lines2 = _expandtabs_lines(lines2, tabsize=4)
+    else:
+        # 窓を使って比較する場合は、行を読みながら展開する
+        lines1 = (_expandtabs(line, tabsize=4) for line in lines1)
+        lines2 = (_expandtabs(line, tabsize=4) for line in lines2)
 
-    for diff in differ.pretty_compare(lines1, lines2, width, withcolor, withbg=withbg):
+    for diff in differ.pretty_compare(lines1, lines2, width, withcolor, withbg=withbg,
+                                      truncate=truncate, window=window):
         yield diff
 
-def _dircmp(dir1, dir2, enc_filepath='utf-8', recursive=False):
-    r"""Compare directories."""
-    dircmp   = DirDiffer(dir1, dir2)
+# -rの場合に、これから表示するサブディレクトリの比較をスレッドで先に進めておく
+# （表示する順に投入し、比較を終えたがまだ表示していないディレクトリの数はlimitまでとする）
+class _DirPrefetcher:
+    r"""Compare subdirectories ahead of rendering in a bounded thread pool.
+
+    Directories are submitted in the order they will be rendered: the
+    subdirectories of the most recently entered directory come first.
+    At most limit directories (default 4 * workers) are compared ahead.
+    With workers None or 1 it does nothing, and each directory is compared
+    when it is rendered.
+    """
+
+    def __init__(self, workers=None, limit=None):
+        self.pool = None
+        if workers is not None and workers > 1:
+            try:
+                import concurrent.futures
+            except ImportError: # python2.x
+                pass
+            else:
+                self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.limit = limit if limit is not None else 4 * (workers or 1)
+        self.futures = {}
+        self.queues = []
+
+    @staticmethod
+    def _prepare(dircmp):
+        # dirtreeが参照する結果(phase0からphase4まで)をすべて求めておく
+        dircmp.same_files
+        dircmp.subdirs
+        return dircmp
+
+    def enter(self, dircmp):
+        """Wait until dircmp is compared, then queue its subdirectories."""
+        if self.pool is None: return
+        future = self.futures.pop(dircmp, None)
+        if future is not None:
+            future.result()
+        else:
+            # まだ投入していなければ、キューから取り除いてこのスレッドで比較する
+            if self.queues and dircmp in self.queues[-1]:
+                if self.queues[-1][0] is dircmp: self.queues[-1].popleft()
+                else:                            self.queues[-1].remove(dircmp)
+            self._prepare(dircmp)
+        self.queues.append(collections.deque(dircmp.subdirs[name]
+                                             for name in sorted(dircmp.subdirs)))
+        self._fill()
+
+    def leave(self):
+        """Forget the queue of the directory whose rendering is finished."""
+        if self.pool is None: return
+        self.queues.pop()
+
+    def _fill(self):
+        while len(self.futures) < self.limit:
+            for queue in reversed(self.queues):
+                if queue: break
+            else:
+                return
+            dircmp = queue.popleft()
+            self.futures[dircmp] = self.pool.submit(self._prepare, dircmp)
+
+    def close(self, wait=True):
+        """Cancel the directories not yet started and shut the pool down."""
+        if self.pool is None: return
+        for future in self.futures.values():
+            future.cancel()
+        self.pool.shutdown(wait=wait)
+        self.pool = None
+
+def _dircmp(dir1, dir2, enc_filepath='utf-8', recursive=False, stat_cache=None,
+            workers=None):
+    r"""Compare directories.
+
+    With recursive and workers > 1, subdirectories are compared ahead of
+    the output in a pool of workers threads (see _DirPrefetcher).
+    """
+    dircmp   = DirDiffer(dir1, dir2, stat_cache=stat_cache)
+    prefetcher = _DirPrefetcher(workers if recursive else None)
     dircmps  = [dircmp]
     dirtrees = [dircmp.dirtree()]
     heads1 = ['|']
     heads2 = ['|']
-    while dirtrees:
-        for dirtree in dirtrees[-1]:
-            (ftype, tag, filepath, dircmpobj, left_islast, right_islast) = dirtree
-
-            try: upath = filepath.decode(enc_filepath)
-            except(AttributeError): upath = filepath
-
-            if left_islast:
-                heads1.pop()
-                heads1.append('`')
-            elif left_islast is None:
-                heads1.pop()
-                heads1.append(' ')
-            if right_islast:
-                heads2.pop()
-                heads2.append('`')
-            elif right_islast is None:
-                heads2.pop()
-                heads2.append(' ')
-
-            head1 = '   '.join(heads1)
-            head2 = '   '.join(heads2)
+    closed = False
+    try:
+        prefetcher.enter(dircmp)
+        while dirtrees:
+            for dirtree in dirtrees[-1]:
+                (ftype, tag, filepath, dircmpobj, left_islast, right_islast) = dirtree
+
+                try: upath = filepath.decode(enc_filepath)
+                except(AttributeError): upath = filepath
+
+                if left_islast:
+                    heads1.pop()
+                    heads1.append('`')
+                elif left_islast is None:
+                    heads1.pop()
+                    heads1.append(' ')
+                if right_islast:
+                    heads2.pop()
+                    heads2.append('`')
+                elif right_islast is None:
+                    heads2.pop()
+                    heads2.append(' ')
+
+                head1 = '   '.join(heads1)
+                head2 = '   '.join(heads2)
+
+                if left_islast:
+                    heads1.pop()
+                    heads1.append(' ')
+                if right_islast:
+                    heads2.pop()
+                    heads2.append(' ')
+
+                cont_mark1 = '   '.join(heads1) + '   '
+                cont_mark2 = '   '.join(heads2) + '   '
+
+                if   ftype == 'd':
+                    upath += '/'
+                    mark = '-+ '
+                elif ftype == 'f':
+                    mark = '-- '
+                else: pass
+
+                if tag == '<':
+                    text1 = upath
+                    text2 = ''
+                    head1 += mark
+                    head2 += '   '
+                elif tag == '>':
+                    text1 = ''
+                    text2 = upath
+                    head1 += '   '
+                    head2 += mark
+                else:
+                    text1 = upath
+                    text2 = upath
 
-            if left_islast:
+                    if not recursive and dircmpobj is not None:
+                        tag = '?'
+                        head1 += '-+ '
+                        head2 += '-+ '
+                    else:
+                        head1 += '-- '
+                        head2 += '-- '
+
+                filepair = None
+
+                if ftype == 'f' and tag == '|':
+                    path1 = os.path.join(dircmps[-1].left,  filepath)
+                    path2 = os.path.join(dircmps[-1].right, filepath)
+
+                    try: upath1 = path1.decode(enc_filepath)
+                    except(AttributeError): upath1 = path1
+                    try: upath2 = path2.decode(enc_filepath)
+                    except(AttributeError): upath2 = path2
+
+                    filepair = (upath1, upath2)
+
+                yield (tag,
+                       head1, text1, head2, text2,
+                       cont_mark1, cont_mark2,
+                       filepair)
+
+                if recursive and dircmpobj is not None:
+                    prefetcher.enter(dircmpobj)
+                    dircmps.append(dircmpobj)
+                    dirtrees.append(dircmpobj.dirtree())
+                    heads1.append('|')
+                    heads2.append('|')
+                    break
+            else:
+                prefetcher.leave()
+                dircmps.pop()
+                dirtrees.pop()
                 heads1.pop()
-                heads1.append(' ')
-            if right_islast:
                 heads2.pop()
-                heads2.append(' ')
-
-            cont_mark1 = '   '.join(heads1) + '   '
-            cont_mark2 = '   '.join(heads2) + '   '
-
-            if   ftype == 'd':
-                upath += '/'
-                mark = '-+ '
-            elif ftype == 'f':
-                mark = '-- '
-            else: pass
-
-            if tag == '<':
-                text1 = upath
-                text2 = ''
-                head1 += mark
-                head2 += '   '
-            elif tag == '>':
-                text1 = ''
-                text2 = upath
-                head1 += '   '
-                head2 += mark
-            else:
-                text1 = upath
-                text2 = upath
-
-                if not recursive and dircmpobj is not None:
-                    tag = '?'
-                    head1 += '-+ '
-                    head2 += '-+ '
-                else:
-                    head1 += '-- '
-                    head2 += '-- '
-
-            filepair = None
-
-            if ftype == 'f' and tag == '|':
-                path1 = os.path.join(dircmps[-1].left,  filepath)
-                path2 = os.path.join(dircmps[-1].right, filepath)
-
-                try: upath1 = path1.decode(enc_filepath)
-                except(AttributeError): upath1 = path1
-                try: upath2 = path2.decode(enc_filepath)
-                except(AttributeError): upath2 = path2
-
-                filepair = (upath1, upath2)
-
-            yield (tag,
-                   head1, text1, head2, text2,
-                   cont_mark1, cont_mark2,
-                   filepair)
-
-            if recursive and dircmpobj is not None:
-                dircmps.append(dircmpobj)
-                dirtrees.append(dircmpobj.dirtree())
-                heads1.append('|')
-                heads2.append('|')
-                break
-        else:
-            dircmps.pop()
-            dirtrees.pop()
-            heads1.pop()
-            heads2.pop()
+    except GeneratorExit:
+        closed = True
+        raise
+    finally:
+        # 途中で閉じられた場合だけ、実行中の比較の終了を待たない
+        prefetcher.close(wait=not closed)
 
 def _parse_unidiff(diff):
     r"""Unified diff parser, takes a file-like object as argument.
@@ -1896,7 +4026,7 @@ def _parse_unidiff(diff):
     return
 
 def _parse_unidiff_and_original_diff(
-        differ, udiffs, width, withcolor=False, withbg=False):
+        differ, udiffs, width, withcolor=False, withbg=False, truncate=None):
     r"""
 
     Example:
@@ -1999,16 +4129,92 @@ def _parse_unidiff_and_original_diff(
         if flag: yield diff
         else:
             for hunk in diff:
-                lines1 = [_expandtabs(str(line)[1:], tabsize=4) for line in hunk.source_lines()]
-                lines2 = [_expandtabs(str(line)[1:], tabsize=4) for line in hunk.target_lines()]
+                lines1 = _expandtabs_lines([str(line)[1:] for line in hunk.source_lines()], tabsize=4)
+                lines2 = _expandtabs_lines([str(line)[1:] for line in hunk.target_lines()], tabsize=4)
 
                 textlinediffs = []
                 for diff in differ.pretty_compare(lines1, lines2, width, withcolor, withbg=withbg,
                     offset1=hunk.source_start - 1,
-                    offset2=hunk.target_start - 1):
+                    offset2=hunk.target_start - 1,
+                    truncate=truncate):
                     yield diff
     return
 
+# 出力する行をまとめて（エンコードも一括で）書き込むクラス
+class OutputSink:
+    r"""Buffered line writer; write lines into a file object in large chunks.
+
+    If encoding is given, fp is a binary stream (e.g. sys.stdout.buffer, a file
+    opened with 'wb' or socket.makefile('wb')) and the lines are encoded in bulk.
+    Otherwise fp is a text stream. If the reader has gone away (broken pipe),
+    further lines are silently dropped and broken is set to True.
+
+    Example:
+
+    >>> import io
+    >>> fp = io.BytesIO()
+    >>> sink = OutputSink(fp, encoding='utf-8', newline='\n')
+    >>> sink.writelines(['a', u'\u3042'])
+    >>> sink.write('b')
+    >>> fp.getvalue() == b''
+    True
+    >>> sink.flush()
+    >>> fp.getvalue() == u'a\n\u3042\nb\n'.encode('utf-8')
+    True
+    """
+
+    def __init__(self, fp, encoding=None, bufsize=BUFSIZE * 8, newline=None):
+        self.fp = fp
+        self.encoding = encoding
+        self.bufsize = bufsize
+        # バイナリで書き込む場合は、TextIOWrapperと同様に改行をos.linesepとする
+        if newline is None: newline = os.linesep if encoding else '\n'
+        self.newline = newline
+        self.buffer = []
+        self.buffered = 0
+        self.broken = False
+
+    def write(self, line):
+        if self.broken: return
+        self.buffer.append(line)
+        self.buffered += len(line) + 1
+        if self.buffered >= self.bufsize: self.flush()
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+            # 読み手がいなくなったら残りの差分は計算しない
+            if self.broken: break
+
+    def flush(self):
+        if not self.buffer or self.broken:
+            self.buffer = []
+            self.buffered = 0
+            return
+        data = self.newline.join(self.buffer) + self.newline
+        self.buffer = []
+        self.buffered = 0
+        if self.encoding: data = data.encode(self.encoding)
+        try:
+            self.fp.write(data)
+            self.fp.flush()
+        except (IOError, OSError) as error:
+            if error.errno != errno.EPIPE: raise
+            self._close_broken_pipe()
+
+    def close(self):
+        self.flush()
+
+    def _close_broken_pipe(self):
+        self.broken = True
+        # 終了時のフラッシュで再びEPIPEにならないように出力先を/dev/nullに付け替える
+        try:
+            devnull = os.open(os.devnull, os.O_WRONLY)
+            os.dup2(devnull, self.fp.fileno())
+            os.close(devnull)
+        except (AttributeError, IOError, OSError, ValueError):
+            pass
+
 def _get_terminal_size():
     env = os.environ
     def ioctl_GWINSZ(fd):
@@ -2083,6 +4289,52 @@ def _make_argparser():
     #
     parser.add_argument('--charjunk', type=str, action='store',
                         help='charjunk')
+    # --algorithmオプション: 行の一致ブロックを検出するエンジンを指定する（デフォルトはdifflib）
+    parser.add_argument('--algorithm', choices=sorted(_engines.keys()), default='difflib',
+                        help='Set line matching algorithm (default difflib)')
+    # --max-costオプション: 一致ブロックの検出と行内差分の相手を探す際の比較の手数の上限を指定する
+    class CheckCount(argparse.Action):
+        def __call__(self, parser, namespace, values, option_string=None):
+            if values < 0:
+                raise argparse.ArgumentError(self, 'set a number not less than 0.')
+            setattr(namespace, self.dest, values)
+    parser.add_argument('--max-cost', metavar='NUM', type=int, default=None,
+                        action=CheckCount,
+                        help='Limit work per file (lines matched, and line pairs and their '
+                        'characters scored); beyond it changed blocks are shown without '
+                        'inline diffs (default unlimited)')
+    # --deadlineオプション: 一致ブロックの検出と行内差分の相手を探す際の時間の上限（秒）を指定する
+    parser.add_argument('--deadline', metavar='SECONDS', type=float, default=None,
+                        action=CheckCount,
+                        help='Limit seconds spent on matching lines and inline diffs per file; '
+                        'beyond it changed blocks are shown without inline diffs '
+                        '(default unlimited)')
+    # --cache-sizeオプション: 行のペアのマッチ率と行内差分をキャッシュする数を指定する
+    parser.add_argument('--cache-size', metavar='NUM', type=int, default=0,
+                        action=CheckCount,
+                        help='Set number of line pairs whose similarity is cached '
+                        'across compared files (default 0, no cache)')
+    # --workersオプション: 行内差分を並列に処理するプロセス数を指定する
+    parser.add_argument('--workers', metavar='NUM', type=int, default=None,
+                        help='Compute inline diffs of changed blocks in NUM processes '
+                        '(default no parallel)')
+    # --dir-workersオプション: ディレクトリの比較でファイルの内容を並列に比較するスレッド数を指定する
+    # （-rの場合は、サブディレクトリの比較も表示より先に並列に進める）
+    parser.add_argument('--dir-workers', metavar='NUM', type=int, default=None,
+                        help='Compare contents of common files in directories '
+                        'with NUM threads, and with -r also compare subdirectories '
+                        'ahead of the output (default no parallel)')
+    # --digest-cacheオプション: ディレクトリの比較でファイルの内容のダイジェストをキャッシュする
+    parser.add_argument('--digest-cache', nargs='?', metavar='PATH', type=str, default=None,
+                        const=_default_digest_cache_path(),
+                        help='Cache digests of file contents keyed by device, inode, size and '
+                        'mtime, so unchanged files are not read again when comparing directories '
+                        '(default PATH $XDG_CACHE_HOME/uxdiff/digests.sqlite3)')
+    # --candidatesオプション: 行内差分の相手を探す際に比較する行数の上限を指定する
+    parser.add_argument('--candidates', metavar='NUM', type=int, default=None,
+                        action=CheckWidth,
+                        help='Limit number of similar line candidates scored per line '
+                        'in large changed blocks (default unlimited)')
     # --cutoffオプション: 差分抽出時の行マージ判定割合を指定する（デフォルトは75%）
     parser.add_argument('--cutoff', metavar='RATIO', type=float, default=0.75,
                         action=CheckRatio,
@@ -2103,6 +4355,18 @@ def _make_argparser():
                 raise argparse.ArgumentError(
                     self, 'LookupError: unknown encoding \'' + values + '\'')
             setattr(namespace, self.dest, values)
+    # --max-line-widthオプション: 長い行は最初の変更箇所の周辺だけを指定された幅で表示する
+    # （前後の省略の印'...'と1文字以上の本文が収まる幅が必要）
+    class CheckLineWidth(argparse.Action):
+        def __call__(self, parser, namespace, values, option_string=None):
+            if values < 2 * len('...') + 1:
+                raise argparse.ArgumentError(
+                    self, 'set a number not less than ' + str(2 * len('...') + 1) + '.')
+            setattr(namespace, self.dest, values)
+    parser.add_argument('--max-line-width', '--truncate', metavar='NUM', type=int, default=None,
+                        action=CheckLineWidth,
+                        help='Show only NUM columns of each line around its first change, '
+                        'eliding the rest with \'...\' (default wrap whole lines)')
     # --enc-file1オプション: 左側のファイルを開く際のコーデックを指定する（デフォルトはutf-8）
     parser.add_argument('--enc-file1', metavar='ENCODING', type=str, default='utf-8',
                         action=CheckCodec,
@@ -2140,6 +4404,23 @@ def _make_argparser():
                         help='Colored diff with background color. '
                         'It will be ignored if no-color option. (default False)')
 
+    # --mmapオプション: ファイルをmmapで開き、表示する行だけをデコードする
+    parser.add_argument('--mmap', action='store_true', default=False,
+                        help='Memory-map files and decode only the lines shown '
+                        '(lines are split at \'\\n\' only) (default False)')
+    # --windowオプション: ファイルを読みながら指定された行数の窓の中で比較する
+    parser.add_argument('--window', metavar='NUM', type=int, default=None, action=CheckWidth,
+                        help='Read files lazily and compare them within a window of NUM lines '
+                        '(constant memory, but diffs may be non-minimal) (default whole files)')
+    # --max-bufferオプション: 出力を保留する行数の上限を指定する（超えた分は一時ファイルに書き出す）
+    parser.add_argument('--max-buffer', metavar='NUM', type=int, default=100000,
+                        action=CheckCount,
+                        help='Hold at most NUM pending output lines in memory, spilling '
+                        'the rest to a temporary file (default 100000)')
+    # --paletteオプション: 色付き表示の配色を指定する（デフォルトはansi）
+    parser.add_argument('--palette', choices=sorted(Theme.palettes.keys()), default='ansi',
+                        help='Set color palette of colored diff (default ansi)')
+
     return parser 
 
 def main():
@@ -2186,9 +4467,6 @@ def _uxdiff(args, parser):
         # メッセージを表示して終了
         parser.error('Need to specify both a file1 and file2')
 
-    context = args.context
-    full = not args.full
-
     try: stdin_buffer = sys.stdin.buffer
     except(AttributeError):
         sys.stdin = codecs.getreader(args.enc_stdin)(sys.stdin) # python2.x
@@ -2198,8 +4476,30 @@ def _uxdiff(args, parser):
     try: stdout_buffer = sys.stdout.buffer
     except(AttributeError):
         sys.stdout = codecs.getwriter(args.enc_stdout)(sys.stdout) # python2.x
+        sink = OutputSink(sys.stdout)
     else:
         sys.stdout = io.TextIOWrapper(stdout_buffer, encoding=args.enc_stdout) # python3.x
+        # 差分はエンコード前の標準出力にまとめて書き込む
+        sink = OutputSink(stdout_buffer, encoding=args.enc_stdout)
+
+    # 同じパスに何度もstatしないように、この実行の間はキャッシュを共有する
+    # --digest-cacheの場合は、ファイルの内容のダイジェストを実行をまたいでキャッシュする
+    digests = None
+    if args.digest_cache is not None:
+        try:
+            digests = _DigestCache(args.digest_cache)
+        except Exception as error: # sqlite3がない場合やキャッシュを開けない場合
+            sys.stderr.write('uxdiff: digest cache disabled: ' + str(error) + '\n')
+    stat_cache = _StatCache(workers=args.dir_workers, digests=digests)
+
+    try: return _write_uxdiff(args, sink, stat_cache)
+    finally:
+        stat_cache.close()
+        sink.close()
+
+def _write_uxdiff(args, sink, stat_cache):
+
+    file_or_dir1, file_or_dir2 = args.file_or_dir_1, args.file_or_dir_2
 
     if args.full:
         context = None
@@ -2212,7 +4512,8 @@ def _uxdiff(args, parser):
         linejunk = None
 
     if args.charjunk != None:
-        charjunk = lambda char: char in args.charjunk
+        # --workersでプロセスに渡せるようにpickle可能な関数とする
+        charjunk = functools.partial(operator.contains, args.charjunk)
     else:
         charjunk = None
 
@@ -2239,6 +4540,9 @@ def _uxdiff(args, parser):
     if withcolor and args.withbg:
         withbg = True
 
+    # 色付き表示の配色は1回だけ組み立てる
+    theme = Theme(args.palette)
+
     differ_class = LikeUnifiedDiffer
     if args.side_by_side:
         differ_class = SideBySideDiffer
@@ -2250,19 +4554,27 @@ def _uxdiff(args, parser):
         cutoff=args.cutoff,
         fuzzy=args.fuzzy,
         cutoffchar=args.cutoffchar,
-        context=context)
+        context=context,
+        engine=args.algorithm,
+        candidates=args.candidates,
+        max_cost=args.max_cost,
+        deadline=args.deadline,
+        workers=args.workers,
+        cache_size=args.cache_size,
+        theme=theme,
+        max_buffer=args.max_buffer)
 
     cmpdir = False
     cmplist = []
     if file_or_dir1 is None:
-        for line in _parse_unidiff_and_original_diff(
+        sink.writelines(_parse_unidiff_and_original_diff(
                 differ,
                 sys.stdin,
                 width=args.width,
                 withcolor=withcolor,
-                withbg=withbg):
-            print(line)
-    elif os.path.isdir(file_or_dir1) and os.path.isdir(file_or_dir2):
+                withbg=withbg,
+                truncate=args.max_line_width))
+    elif stat_cache.kind(file_or_dir1) == 'd' and stat_cache.kind(file_or_dir2) == 'd':
         # diff [DIR] and [DIR]
         cmpdir = True
 
@@ -2270,11 +4582,12 @@ def _uxdiff(args, parser):
                                  '', file_or_dir1 + '/', '', file_or_dir2 + '/',
                                  args.width,
                                  cont_mark1='', cont_mark2='', sep_mark='',
-                                 withcolor=withcolor):
-            print(line)
+                                 withcolor=withcolor, theme=theme):
+            sink.write(line)
 
         for result in _dircmp(file_or_dir1, file_or_dir2,
-                             args.enc_filepath, args.recursive):
+                             args.enc_filepath, args.recursive, stat_cache,
+                             workers=args.dir_workers):
             (tag,
             head1, text1,
             head2, text2,
@@ -2287,21 +4600,21 @@ def _uxdiff(args, parser):
                                      cont_mark1=cont_mark1,
                                      cont_mark2=cont_mark2,
                                      sep_mark='',
-                                     withcolor=withcolor):
-                print(line)
+                                     withcolor=withcolor, theme=theme):
+                sink.write(line)
             if filepair is not None:
                 cmplist.append(filepair)
-        print('')
+        sink.write('')
     else:
         try: file_or_dir1 = file_or_dir1.decode(args.enc_filepath) # python2.x
         except(AttributeError): pass # python3.x
         try: file_or_dir2 = file_or_dir2.decode(args.enc_filepath) # python2.x
         except(AttributeError): pass # python3.x
 
-        if   os.path.isdir(file_or_dir1):
+        if   stat_cache.kind(file_or_dir1) == 'd':
             # diff [DIR/FILE] and [FILE]
             cmplist = [(os.path.join(file_or_dir1, os.path.basename(file_or_dir2)), file_or_dir2)]
-        elif os.path.isdir(file_or_dir2):
+        elif stat_cache.kind(file_or_dir2) == 'd':
             # diff [FILE] and [DIR/FILE]
             cmplist = [(file_or_dir1, os.path.join(file_or_dir2, os.path.basename(file_or_dir1)))]
         else:
@@ -2324,8 +4637,8 @@ def _uxdiff(args, parser):
             label[0] = file1
             label[1] = file2
 
-            is_text_file1 = _is_text(file1)
-            is_text_file2 = _is_text(file2)
+            is_text_file1 = stat_cache.is_text(file1)
+            is_text_file2 = stat_cache.is_text(file2)
 
             if not (is_text_file1 and is_text_file2):
                 if is_text_file1: filetype1 = 'Text'
@@ -2347,14 +4660,51 @@ def _uxdiff(args, parser):
             filetype1 = args.enc_file1
             filetype2 = args.enc_file2
 
-        print('--- ' + label[0] + ' (' + filetype1 + ')')
-        print('+++ ' + label[1] + ' (' + filetype2 + ')')
+        sink.write('--- ' + label[0] + ' (' + filetype1 + ')')
+        sink.write('+++ ' + label[1] + ' (' + filetype2 + ')')
 
         if not (is_text_file1 and is_text_file2):
-            print('Files ' + file1 + ' and ' + file2 + ' differ')
-            print('')
+            sink.write('Files ' + file1 + ' and ' + file2 + ' differ')
+            sink.write('')
+            continue
+
+        # 内容が完全に同一のファイルはデコードせずに空のシーケンス同士として扱う
+        # （コンテキスト差分では同一の行は出力されないため）
+        if context is not None and stat_cache.same(file1, file2):
+            for line in _original_diff(
+                    differ, [], [],
+                    width=args.width,
+                    withcolor=withcolor,
+                    withbg=withbg):
+                sink.write(line)
             continue
 
+        # 1組のファイルの差分を出力する（Noneでなければ、その値で終了する）
+        status = _write_file_diff(args, sink, differ, file1, file2, cmpdir,
+                                  withcolor, withbg)
+        if status is not None: return status
+    return 0
+
+# 1組のファイルを開いて差分を出力する
+# 次のファイルに進む場合はNoneを、終了する場合は終了コードを返す
+def _write_file_diff(args, sink, differ, file1, file2, cmpdir, withcolor, withbg):
+
+    # デコードできなかったファイル(0または1)について、エンコーディングの指定を促す
+    def decode_error(index):
+        filename = (file1, file2)[index]
+        encoding_text = (args.enc_file1, args.enc_file2)[index]
+        optionname = ('--enc-file1', '--enc-file2')[index]
+        sink.write('\'' + filename  + '\' is not encoding by \'' + encoding_text + '\'')
+        sink.write('Set correct encoding of \'' + filename + '\' by ' + optionname + ' option')
+        if cmpdir:
+            sink.write('')
+            return None
+        else:
+            return 1
+
+    # 開いたファイルは、差分を出力し終えたら(エラーの場合も)閉じる
+    opened = []
+    try:
         # 入力ファイルを開く
         lines1 = None
         lines2 = None
@@ -2363,41 +4713,50 @@ def _uxdiff(args, parser):
             # lines1 = open(file1, 'r', encoding=args.enc_file1)
             # lines2 = open(file2, 'r', encoding=args.enc_file2)
             # for Python2.x
-            lines1 = codecs.open(file1, 'r', encoding=args.enc_file1).readlines()
-            lines2 = codecs.open(file2, 'r', encoding=args.enc_file2).readlines()
+            # --windowの場合はファイルを読みながら比較する
+            # （デコードのエラーは比較の途中で発生するので、どちらのファイルかを付けておく）
+            # --mmapの場合は行の位置だけを索引し、表示する行だけをデコードする
+            if args.mmap and args.window is None and _is_mappable(args.enc_file1, args.enc_file2):
+                # デコードのエラーは表示する行をデコードするときに発生する
+                lines1 = MappedLines(file1, args.enc_file1, strip_eol=args.ignore_crlf,
+                                     file_index=0)
+                opened.append(lines1)
+                lines2 = MappedLines(file2, args.enc_file2, strip_eol=args.ignore_crlf,
+                                     file_index=1)
+                opened.append(lines2)
+            else:
+                lines1 = codecs.open(file1, 'r', encoding=args.enc_file1)
+                opened.append(lines1)
+                if args.window is None: lines1 = lines1.readlines()
+                else:                   lines1 = _decode_lazily(lines1, 0)
+                lines2 = codecs.open(file2, 'r', encoding=args.enc_file2)
+                opened.append(lines2)
+                if args.window is None: lines2 = lines2.readlines()
+                else:                   lines2 = _decode_lazily(lines2, 1)
         # for Python2.x
         except IOError:
             if lines1 is None:
                 filename = file1
             else:
                 filename = file2
-            print('[Errno 2] No such file or directory: \'' + filename + '\'')
+            sink.write('[Errno 2] No such file or directory: \'' + filename + '\'')
             return 1
         except UnicodeDecodeError:
-            if lines1 is None:
-                filename = file1
-                encoding_text = args.enc_file1
-                optionname = '--enc-file1'
-            else:
-                filename = file2
-                encoding_text = args.enc_file2
-                optionname = '--enc-file2'
-            print('\'' + filename  + '\' is not encoding by \'' + encoding_text + '\'')
-            print('Set correct encoding of \'' + filename + '\' by ' + optionname + ' option')
-            if cmpdir:
-                print('')
-                continue
-            else:
-                return 1
+            return decode_error(0 if lines1 is None else 1)
         # for Python3.x
         # except IOError as error:
         #     print(str(error))
         # except UnicodeDecodeError as error:
         #     print(str(error))
 
-        if args.ignore_crlf:
+        if isinstance(lines1, MappedLines):
+            pass # 行末はMappedLinesが取り除く
+        elif args.ignore_crlf and args.window is None:
             lines1 = [line.rstrip('\r\n') for line in lines1]
             lines2 = [line.rstrip('\r\n') for line in lines2]
+        elif args.ignore_crlf:
+            lines1 = (line.rstrip('\r\n') for line in lines1)
+            lines2 = (line.rstrip('\r\n') for line in lines2)
 
         # expandtabsは幅広文字に対応していないので自前で対処する
         # 以下のコードを試せば分かる
@@ -2410,10 +4769,37 @@ def _uxdiff(args, parser):
             lines1, lines2,
             width=args.width,
             withcolor=withcolor,
-            withbg=withbg)
+            withbg=withbg,
+            truncate=args.max_line_width,
+            window=args.window)
 
-        for line in diff: print(line)
-    return 0
+        try:
+            sink.writelines(diff)
+        except UnicodeDecodeError as error:
+            # 読みながら比較する場合や--mmapの場合は、ここでデコードのエラーが発生する
+            index = getattr(error, 'file_index', None)
+            if index is None: raise
+            return decode_error(index)
+        if sink.broken: return 0
+
+        if differ.degraded:
+            sys.stderr.write('uxdiff: ' + str(len(differ.degraded)) +
+                             ' changed block(s) of \'' + file2 +
+                             '\' shown without inline diffs (budget exceeded)\n')
+        return None
+    finally:
+        for fp in opened:
+            fp.close()
+
+# 読みながらデコードする行の列を返す
+# デコードのエラーには、どちらのファイル(0または1)かをfile_indexとして付ける
+def _decode_lazily(lines, index):
+    try:
+        for line in lines:
+            yield line
+    except UnicodeDecodeError as error:
+        error.file_index = index
+        raise
 
 if __name__ == "__main__":
     sys.exit(main())